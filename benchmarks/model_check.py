@@ -0,0 +1,915 @@
+# Randomized stateful check of AddressBook and NoteBook against a plain
+# reference model, doubling as a load generator.
+#
+# A long random sequence of handler commands (add, change, rename,
+# add-birthday, add-address, set-region, dedupe with and without --merge,
+# the note commands, merge-notes from a second notebook that grows along
+# the way, undo and redo) runs against the real books, wired to an EventBus
+# with the RenderCache and the CompletionIndex subscribed like in the
+# assistant, and against Model, which keeps contacts and notes in plain
+# dicts, implements undo with whole-state snapshots and answers every query
+# by brute force.
+#
+# Every `every` commands the queries find, search_by_tags, sort_by_tags and
+# get_upcoming_birthdays are compared with the model; every ten times that
+# the whole state, the note link index, the cached listings and the
+# completion candidates are compared as well. Each command's reply must
+# match the one the model predicts, errors included. On a mismatch the seed,
+# the step and the last commands are printed.
+#
+# Handler and query calls are timed on their own, so the ops/sec reported
+# at the end leave out the model.
+#
+# Run from the repository root:
+#     python benchmarks/model_check.py [commands] [seed] [every]
+
+import calendar
+import random
+import sys
+import time
+import unicodedata
+from collections import Counter, deque
+from datetime import date, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import calendars  # noqa: E402
+import handlers as h  # noqa: E402
+from address_book import AddressBook, Record  # noqa: E402
+from completion import CompletionIndex  # noqa: E402
+from events import EventBus  # noqa: E402
+from fields import normalize_name  # noqa: E402
+from history import History  # noqa: E402
+from note_book import NoteBook  # noqa: E402
+from render_cache import RenderCache  # noqa: E402
+
+FIRST_NAMES = ["Ann", "Bob", "Olena", "Zoë", "Łukasz", "Mia", "Taras"]
+WORDS = ["call", "meeting", "  lunch", "report", "gift", "trip  ", "plan"]
+TAGS = ["work", "Home", "todo", "URGENT", "family"]
+REGIONS = ["none", "us", "gb", "de", "US", "xx"]
+HISTORY_LIMIT = 40
+# Name of the book under test, as merge-notes sees it
+BOOK = "default"
+# Small enough for long runs to compact the note list repeatedly
+COMPACT_MIN = 16
+# Names that start out in the book in several spellings with the same
+# normalised key, as only books saved before names were normalised hold
+LEGACY_VARIANTS = 5
+
+WEIGHTS = {
+    "add": 20, "change": 5, "rename": 4, "add-birthday": 8,
+    "add-address": 4, "set-region": 3, "add-note": 15, "edit-note": 4,
+    "delete-note": 5, "tag-note": 8, "untag-note": 4, "retag": 2,
+    "link-note": 6, "unlink-note": 3, "dedupe": 2, "merge-notes": 2,
+    "undo": 5, "redo": 3,
+}
+
+
+class Rejected(Exception):
+    # The reply the real handler is expected to give instead
+    pass
+
+
+# input_error replies with str() of a KeyError, which quotes the message
+NO_CONTACT = repr("Contact not found.")
+NO_NOTE = repr("Note not found.")
+
+
+def count_message(message: str, count: int, noun: str = "notes") -> str:
+    if count == 1:
+        return f"{message}."
+    return f"{message} ({count} {noun})."
+
+
+def check_phone(phone: str):
+    if not phone.isdigit():
+        raise Rejected("Phone number must contain only digits (0-9).")
+    if len(phone) != 10:
+        raise Rejected("Phone number must be exactly 10 digits.")
+
+
+def parse_birthday(text: str) -> date:
+    try:
+        day, month, year = map(int, text.split("."))
+        return date(year, month, day)
+    except ValueError:
+        raise Rejected("Invalid date format. Use DD.MM.YYYY")
+
+
+class Model:
+    # Contacts: display name -> {"phones", "birthday", "address", "region"};
+    # notes: id -> {"text", "tags", "contacts", "origin"} with tags and
+    # contacts as sets, since undo may put them back in another order.
+    # Entries are copied before they change, so a snapshot is a shallow copy
+    # of the two dicts. other holds the notes of the second notebook as
+    # {"id", "text", "tags", "contacts"}, in id order.
+    def __init__(self, other_uid: str):
+        self.contacts = {}
+        self.notes = {}
+        self.next_id = 1
+        self.region = None
+        self.other = []
+        self.other_uid = other_uid
+        # Cleared by commands that leave no history entry
+        self.recorded = True
+        self._undo = deque(maxlen=HISTORY_LIMIT)
+        self._redo = deque(maxlen=HISTORY_LIMIT)
+
+    # State and undo
+
+    def _state(self):
+        return dict(self.contacts), dict(self.notes)
+
+    def _recorded(self, before):
+        self._undo.append(before)
+        self._redo.clear()
+
+    def _contact(self, display: str) -> dict:
+        contact = dict(self.contacts[display])
+        contact["phones"] = list(contact["phones"])
+        self.contacts[display] = contact
+        return contact
+
+    def _note(self, note_id: int) -> dict:
+        note = self.notes[note_id]
+        note = self.notes[note_id] = {"text": note["text"],
+                                      "tags": set(note["tags"]),
+                                      "contacts": set(note["contacts"]),
+                                      "origin": note["origin"]}
+        return note
+
+    def undo(self, args=()):
+        self.recorded = False
+        if not self._undo:
+            raise Rejected("Nothing to undo.")
+        self._redo.append(self._state())
+        self.contacts, self.notes = self._undo.pop()
+
+    def redo(self, args=()):
+        self.recorded = False
+        if not self._redo:
+            raise Rejected("Nothing to redo.")
+        self._undo.append(self._state())
+        self.contacts, self.notes = self._redo.pop()
+
+    # Queries
+
+    def find(self, name: str):
+        # The exact spelling first, as a legacy book may hold variants
+        if name in self.contacts:
+            return name
+        key = normalize_name(name)
+        return min((n for n in self.contacts if normalize_name(n) == key),
+                   default=None)
+
+    def _select(self, args):
+        if args[0] == "--tag":
+            wanted = args[1].strip().lower()
+            ids = [i for i in sorted(self.notes)
+                   if wanted in self.notes[i]["tags"]]
+        else:
+            first, _, last = args[0].partition("-")
+            first, last = int(first), int(last or first)
+            ids = [i for i in sorted(self.notes) if first <= i <= last]
+        if not ids:
+            raise Rejected(NO_NOTE)
+        return ids, args[2:] if args[0] == "--tag" else args[1:]
+
+    def search_by_tags(self, tags):
+        wanted = {t.strip().lower() for t in tags}
+        return [i for i in sorted(self.notes)
+                if self.notes[i]["tags"] & wanted]
+
+    def sort_by_tags(self):
+        return sorted(self.notes, key=lambda i: (
+            min(self.notes[i]["tags"], default="~"), i))
+
+    def upcoming_birthdays(self, days: int, today: date, region: str):
+        def clamp(year, month, day):
+            return date(year, month,
+                        min(day, calendar.monthrange(year, month)[1]))
+
+        book_calendar = calendars.get_calendar(region)
+        found = []
+        for name, contact in self.contacts.items():
+            born = contact["birthday"]
+            if born is None:
+                continue
+            upcoming = clamp(today.year, born.month, born.day)
+            if upcoming < today:
+                upcoming = clamp(today.year + 1, born.month, born.day)
+            if (upcoming - today).days >= days:
+                continue
+            business = calendars.CALENDARS.get(contact["region"],
+                                               book_calendar)
+            while not business.is_workday(upcoming):
+                upcoming += timedelta(days=1)
+            found.append((upcoming, name))
+        return sorted(found)
+
+    # Commands; each returns the expected reply or raises Rejected
+
+    def add(self, args):
+        pairs = list(zip(args[::2], args[1::2]))
+        for _, phone in pairs:
+            check_phone(phone)
+        contacts = dict(self.contacts)
+        added = 0
+        for name, phone in pairs:
+            display = self.find(name)
+            if display is None:
+                self.contacts[name] = {"phones": [phone], "birthday": None,
+                                       "address": None, "region": None}
+                added += 1
+            elif phone in self.contacts[display]["phones"]:
+                self.contacts = contacts
+                raise Rejected("Phone number already exists.")
+            else:
+                self._contact(display)["phones"].append(phone)
+        if len(pairs) == 1:
+            return "Contact added." if added else "Contact updated."
+        return f"Contacts added: {added}, updated: {len(pairs) - added}."
+
+    def change(self, args):
+        name, old, new = args
+        display = self.find(name)
+        if display is None:
+            raise Rejected(NO_CONTACT)
+        phones = self.contacts[display]["phones"]
+        if old not in phones:
+            raise Rejected("Phone number not found.")
+        check_phone(new)
+        if new != old and new in phones:
+            raise Rejected("Phone number already exists.")
+        self._contact(display)["phones"][phones.index(old)] = new
+        return "Phone number updated."
+
+    def rename(self, args):
+        old, new = args
+        if old == new:
+            raise Rejected("New name must be different.")
+        display = self.find(old)
+        if display is None:
+            raise Rejected(NO_CONTACT)
+        if self.find(new) not in (None, display):
+            raise Rejected("Contact with this name already exists.")
+        if new == display:
+            raise Rejected("New name must be different.")
+        self.contacts[new] = self.contacts.pop(display)
+        for note_id, note in list(self.notes.items()):
+            if display in note["contacts"]:
+                note = self._note(note_id)
+                note["contacts"].discard(display)
+                note["contacts"].add(new)
+        return "Contact renamed."
+
+    def add_birthday(self, args):
+        pairs = list(zip(args[::2], args[1::2]))
+        updates = []
+        for name, text in pairs:
+            born = parse_birthday(text)
+            display = self.find(name)
+            if display is None:
+                raise Rejected(NO_CONTACT)
+            updates.append((display, born))
+        for display, born in updates:
+            self._contact(display)["birthday"] = born
+        return count_message("Birthday set", len(pairs), "contacts")
+
+    def add_address(self, args):
+        display = self.find(args[0])
+        if display is None:
+            raise Rejected(NO_CONTACT)
+        self._contact(display)["address"] = " ".join(args[1:])
+        return "Address set."
+
+    def set_region(self, args):
+        region = args[0]
+        display = None
+        if len(args) > 1:
+            display = self.find(args[1])
+            if display is None:
+                raise Rejected(NO_CONTACT)
+            if region.lower() == "book":
+                self._contact(display)["region"] = None
+                return f"{display} follows the book's region."
+        if region.lower() not in calendars.CALENDARS:
+            raise Rejected(
+                f"Unknown region: {region}. Known regions: "
+                f"{', '.join(sorted(calendars.CALENDARS))}.")
+        if display is None:
+            self.region = region.lower()
+            self.recorded = False
+            return f"Region set to {calendars.get_calendar(region).name}."
+        self._contact(display)["region"] = region.lower()
+        return (f"Region of {display} set to "
+                f"{calendars.get_calendar(region).name}.")
+
+    def add_note(self, args):
+        note_id = self.next_id
+        self.next_id += 1
+        self.notes[note_id] = {"text": " ".join(args).strip(), "tags": set(),
+                               "contacts": set(), "origin": None}
+        return f"Note added with id {note_id}."
+
+    def edit_note(self, args):
+        note_id = int(args[0])
+        if note_id not in self.notes:
+            raise Rejected(NO_NOTE)
+        self._note(note_id)["text"] = " ".join(args[1:]).strip()
+        return "Note updated."
+
+    def delete_note(self, args):
+        ids, _ = self._select(args)
+        for note_id in ids:
+            del self.notes[note_id]
+        return count_message("Note deleted", len(ids))
+
+    def tag_note(self, args, added=True):
+        ids, rest = self._select(args)
+        tags = {t.strip().lower() for t in rest}
+        changed = [i for i in ids if (tags - self.notes[i]["tags"] if added
+                                      else tags & self.notes[i]["tags"])]
+        for note_id in changed:
+            if added:
+                self._note(note_id)["tags"] |= tags
+            else:
+                self._note(note_id)["tags"] -= tags
+        self.recorded = bool(changed)
+        return count_message("Tags added" if added else "Tags removed",
+                             len(changed))
+
+    def untag_note(self, args):
+        return self.tag_note(args, added=False)
+
+    def retag(self, args):
+        old, new = (t.strip().lower() for t in args)
+        if old == new:
+            raise Rejected("New tag must be different.")
+        ids = [i for i in self.notes if old in self.notes[i]["tags"]]
+        if not ids:
+            raise Rejected(NO_NOTE)
+        for note_id in ids:
+            tags = self._note(note_id)["tags"]
+            tags.discard(old)
+            tags.add(new)
+        return count_message("Tag renamed", len(ids))
+
+    def link_note(self, args):
+        ids, rest = self._select(args)
+        display = self.find(rest[0])
+        if display is None:
+            raise Rejected(NO_CONTACT)
+        linked = [i for i in ids if display not in self.notes[i]["contacts"]]
+        for note_id in linked:
+            self._note(note_id)["contacts"].add(display)
+        self.recorded = bool(linked)
+        return count_message(f"Linked to {display}", len(linked))
+
+    def unlink_note(self, args):
+        ids, rest = self._select(args)
+        name = self.find(rest[0]) or rest[0]
+        unlinked = [i for i in ids if name in self.notes[i]["contacts"]]
+        if not unlinked:
+            raise Rejected(f"Note is not linked to {name}.")
+        for note_id in unlinked:
+            self._note(note_id)["contacts"].discard(name)
+        return count_message(f"Unlinked from {name}", len(unlinked))
+
+    def _clusters(self):
+        # Groups of contacts linked by a shared normalised name, phone, or
+        # birthday together with the first name, as (sorted names, reasons)
+        holders = {}
+        for name, contact in self.contacts.items():
+            key = normalize_name(name)
+            keys = [("name", key)] + [("phone", p) for p in contact["phones"]]
+            if contact["birthday"] is not None:
+                keys.append(("birthday", contact["birthday"],
+                             key.split(" ", 1)[0]))
+            for k in keys:
+                holders.setdefault(k, set()).add(name)
+        shared = [(k, names) for k, names in holders.items() if len(names) > 1]
+        neighbours = {}
+        for _, names in shared:
+            for name in names:
+                neighbours.setdefault(name, set()).update(names)
+        group_of = {}
+        clusters = []
+        for start in sorted(neighbours):
+            if start in group_of:
+                continue
+            group, todo = set(), [start]
+            while todo:
+                name = todo.pop()
+                if name not in group:
+                    group.add(name)
+                    todo.extend(neighbours[name] - group)
+            for name in group:
+                group_of[name] = len(clusters)
+            clusters.append((sorted(group), set()))
+        for k, names in shared:
+            clusters[group_of[next(iter(names))]][1].add(k[0])
+        return sorted(((names, sorted(kinds)) for names, kinds in clusters),
+                      key=lambda c: c[0][0].lower())
+
+    def dedupe(self, args):
+        clusters = self._clusters()
+        if not clusters or not args:
+            self.recorded = False
+            if not clusters:
+                return "No duplicate contacts found."
+            lines = [f"{i}. {', '.join(names)} (same {', '.join(kinds)})"
+                     for i, (names, kinds) in enumerate(clusters, start=1)]
+            lines.append(f"{len(clusters)} cluster(s). "
+                         "Run 'dedupe --merge' to merge them.")
+            return "\n".join(lines)
+
+        def completeness(name):
+            contact = self.contacts[name]
+            return -(len(contact["phones"]) + (contact["birthday"] is not None)
+                     + (contact["address"] is not None)), name
+
+        lines = []
+        merged = 0
+        for names, _ in clusters:
+            target = min(names, key=completeness)
+            for source in names:
+                if source == target:
+                    continue
+                merged += 1
+                kept = self._contact(target)
+                other = self.contacts.pop(source)
+                kept["phones"] += [p for p in other["phones"]
+                                   if p not in kept["phones"]]
+                conflicts = []
+                for field in ("birthday", "address"):
+                    if other[field] is None:
+                        continue
+                    if kept[field] is None:
+                        kept[field] = other[field]
+                    elif kept[field] != other[field]:
+                        conflicts.append(field)
+                if conflicts:
+                    lines.append(f"{source} -> {target}: kept {target}'s "
+                                 f"{' and '.join(conflicts)}")
+                for note_id, note in list(self.notes.items()):
+                    if source in note["contacts"]:
+                        note = self._note(note_id)
+                        note["contacts"].discard(source)
+                        note["contacts"].add(target)
+        lines.append(f"Merged {merged} contact(s) into "
+                     f"{len(clusters)} record(s).")
+        return "\n".join(lines)
+
+    def merge_notes(self, args):
+        if args[0] == BOOK:
+            raise Rejected("Cannot merge a notebook into itself.")
+        present = {n["origin"] for n in self.notes.values()}
+        incoming = [n for n in self.other
+                    if f"{self.other_uid}:{n['id']}" not in present]
+        if not incoming:
+            self.recorded = False
+            return "No new notes to merge."
+        offset = self.next_id - incoming[0]["id"]
+        for source in incoming:
+            contacts = {self.find(c) for c in source["contacts"]} - {None}
+            self.notes[source["id"] + offset] = {
+                "text": source["text"], "tags": set(source["tags"]),
+                "contacts": contacts,
+                "origin": f"{self.other_uid}:{source['id']}"}
+        first, last = incoming[0]["id"] + offset, incoming[-1]["id"] + offset
+        self.next_id = last + 1
+        return f"Merged {len(incoming)} note(s) as ids {first}-{last}."
+
+
+class Books:
+    # The real books, wired like in the assistant; legacy is a list of
+    # (name, phone) loaded the way an old single-file book is imported
+    def __init__(self, legacy=()):
+        self.events = EventBus()
+        self.cache = RenderCache()
+        self.completion = CompletionIndex()
+        records = {}
+        for name, phone in legacy:
+            records[name] = Record(name)
+            records[name].add_phone(phone)
+        self.address_book = AddressBook(records)
+        self.note_book = NoteBook()
+        self.note_book.COMPACT_MIN = COMPACT_MIN
+        self.address_book.note_book = self.note_book
+        self.address_book.set_events(self.events)
+        self.note_book.events = self.events
+        self.events.subscribe(self.cache)
+        self.events.subscribe(self.completion)
+        self.completion.prefetch(self.address_book.name_snapshot(),
+                                 []).join()
+        self.history = History(HISTORY_LIMIT)
+        # Notes of another book, for merge-notes
+        self.other = NoteBook()
+        # Stands in for the assistant in set-region and merge-notes
+        self.settings = SimpleNamespace(
+            address_book=self.address_book, note_book=self.note_book,
+            region=None, open_note_book=lambda name: (
+                self.note_book if name == BOOK else self.other))
+
+    def run(self, command: str, args):
+        ab, nb, hist = self.address_book, self.note_book, self.history
+        self.events.hold()
+        try:
+            if command == "add":
+                return h.add_contact(args, ab, hist)
+            if command == "change":
+                return h.change_phone(args, ab, hist)
+            if command == "rename":
+                return h.rename(args, ab, hist)
+            if command == "add-birthday":
+                return h.add_birthday(args, ab, hist)
+            if command == "add-address":
+                return h.add_address(args, ab, hist)
+            if command == "set-region":
+                return h.set_region(args, self.settings, hist)
+            if command == "add-note":
+                return h.add_note(args, nb, hist)
+            if command == "edit-note":
+                return h.edit_note(args, nb, hist)
+            if command == "delete-note":
+                return h.delete_note(args, nb, hist)
+            if command == "tag-note":
+                return h.tag_note(args, nb, hist)
+            if command == "untag-note":
+                return h.untag_note(args, nb, hist)
+            if command == "retag":
+                return h.retag(args, nb, hist)
+            if command == "link-note":
+                return h.link_note(args, nb, ab, hist)
+            if command == "unlink-note":
+                return h.unlink_note(args, nb, ab, hist)
+            if command == "dedupe":
+                return h.dedupe(args, ab, hist)
+            if command == "merge-notes":
+                return h.merge_notes(args, self.settings, hist)
+            if command == "undo":
+                return h.undo(args, hist)
+            if command == "redo":
+                return h.redo(args, hist)
+            raise ValueError(f"Unknown command: {command}")
+        finally:
+            self.events.release()
+
+
+class Generator:
+    # Random command arguments, biased towards names, ids and tags that
+    # exist so most commands succeed
+    def __init__(self, rnd: random.Random, model: Model, names: int):
+        self.rnd = rnd
+        self.model = model
+        self.names = [f"{FIRST_NAMES[i % len(FIRST_NAMES)]}"
+                      f"{i // len(FIRST_NAMES) or ''}" for i in range(names)]
+        # Commands to issue next: batch commands are often undone and
+        # redone right away, before later commands bury them in the history
+        self.queued = deque()
+
+    def name(self) -> str:
+        rnd = self.rnd
+        if self.model.contacts and rnd.random() < 0.6:
+            name = rnd.choice(list(self.model.contacts))
+        else:
+            name = rnd.choice(self.names)
+        variant = rnd.random()
+        if variant < 0.1:
+            return name.lower()
+        if variant < 0.15:
+            return name.upper()
+        if variant < 0.2:
+            return unicodedata.normalize("NFD", name)
+        return name
+
+    def phone(self) -> str:
+        # Mostly distinct numbers, with a small shared pool so some contacts
+        # share a phone and dedupe finds clusters without merging them all
+        rnd = self.rnd
+        if rnd.random() < 0.05:
+            return rnd.choice(["12345", "12345abcde", "123456789012"])
+        if rnd.random() < 0.1:
+            return f"{rnd.randrange(100):010d}"
+        return f"{rnd.randrange(10 ** 6):010d}"
+
+    def known_phone(self, name: str) -> str:
+        display = self.model.find(name)
+        if display is not None and self.rnd.random() < 0.8:
+            return self.rnd.choice(self.model.contacts[display]["phones"])
+        return self.phone()
+
+    def birthday(self) -> str:
+        rnd = self.rnd
+        return (f"{rnd.randint(1, 31):02d}.{rnd.randint(1, 12):02d}."
+                f"{rnd.randint(1950, 2010)}")
+
+    def text(self):
+        return [self.rnd.choice(WORDS) for _ in range(self.rnd.randint(1, 4))]
+
+    def tag(self) -> str:
+        tag = self.rnd.choice(TAGS)
+        return tag.lower() if self.rnd.random() < 0.3 else tag
+
+    def selector(self):
+        rnd = self.rnd
+        ids = list(self.model.notes)
+        if rnd.random() < 0.15:
+            return ["--tag", self.tag()]
+        if not ids or rnd.random() < 0.05:
+            return [str(rnd.randint(1, self.model.next_id + 1))]
+        first = rnd.choice(ids)
+        if rnd.random() < 0.2:
+            return [f"{first}-{first + rnd.randint(0, 20)}"]
+        return [str(first)]
+
+    def command(self):
+        rnd = self.rnd
+        if self.queued:
+            return self.queued.popleft(), []
+        command = rnd.choices(list(WEIGHTS), list(WEIGHTS.values()))[0]
+        if command == "add":
+            args = []
+            for _ in range(1 if rnd.random() < 0.9 else rnd.randint(2, 3)):
+                name = self.name()
+                args += [name, self.known_phone(name) if rnd.random() < 0.1
+                         else self.phone()]
+        elif command == "change":
+            name = self.name()
+            args = [name, self.known_phone(name), self.phone()]
+        elif command == "rename":
+            args = [self.name(), rnd.choice(self.names)]
+        elif command == "add-birthday":
+            args = []
+            for _ in range(1 if rnd.random() < 0.9 else 2):
+                args += [self.name(), self.birthday()]
+        elif command == "add-address":
+            args = [self.name(), "Kyiv,", f"Street {rnd.randint(1, 50)}"]
+        elif command == "set-region":
+            region = rnd.choice(REGIONS + ["book"])
+            if rnd.random() < 0.1 and region != "book":
+                args = [region]
+            else:
+                args = [region, self.name()]
+        elif command in ("add-note", "edit-note"):
+            args = self.text()
+            if command == "edit-note":
+                args = self.selector()[:1] + args
+                if not args[0].isdigit():
+                    args[0] = str(self.model.next_id)
+        elif command == "delete-note":
+            args = self.selector()
+        elif command in ("tag-note", "untag-note"):
+            args = self.selector() + [self.tag()
+                                      for _ in range(rnd.randint(1, 2))]
+        elif command == "retag":
+            args = [self.tag(), self.tag()]
+        elif command == "unlink-note":
+            linked = [i for i, n in self.model.notes.items() if n["contacts"]]
+            if linked and rnd.random() < 0.8:
+                note_id = rnd.choice(linked)
+                args = [str(note_id), rnd.choice(
+                    sorted(self.model.notes[note_id]["contacts"]))]
+            else:
+                args = self.selector() + [self.name()]
+        elif command == "link-note":
+            args = self.selector() + [self.name()]
+        elif command == "dedupe":
+            args = ["--merge"] if rnd.random() < 0.7 else []
+        elif command == "merge-notes":
+            args = [BOOK if rnd.random() < 0.1 else "team"]
+        else:
+            args = []
+        if command in ("dedupe", "merge-notes") and rnd.random() < 0.5:
+            self.queued.append("undo")
+            if rnd.random() < 0.5:
+                self.queued.append("redo")
+        return command, args
+
+
+class Mismatch(AssertionError):
+    pass
+
+
+def note_state(note):
+    return {"text": note.text.value, "tags": {t.value for t in note.tags},
+            "contacts": set(note.contacts), "origin": note.origin}
+
+
+def contact_state(record):
+    return {"phones": [p.value for p in record.phones],
+            "birthday": record.birthday.value if record.birthday else None,
+            "address": record.address.value if record.address else None,
+            "region": record.region}
+
+
+class Checker:
+    def __init__(self, commands: int, seed: int, every: int):
+        self.rnd = random.Random(seed)
+        self.seed = seed
+        self.commands = commands
+        self.every = every
+        names = max(len(FIRST_NAMES), commands // 10)
+        legacy = []
+        for i in range(LEGACY_VARIANTS):
+            base = f"{FIRST_NAMES[i]}{names // len(FIRST_NAMES) + i}"
+            for j, name in enumerate((base.lower(), base, base.upper())):
+                legacy.append((name, f"{9000000000 + i * 10 + j}"))
+        self.books = Books(legacy)
+        self.model = Model(self.books.other.uid)
+        for name, phone in legacy:
+            self.model.contacts[name] = {"phones": [phone], "birthday": None,
+                                         "address": None, "region": None}
+        self.generator = Generator(self.rnd, self.model, names)
+        self.recent = deque(maxlen=15)
+        # Name -> [calls, seconds]; queries are prefixed with "?"
+        self.timings = {}
+        self.rejected = Counter()
+
+    def timed(self, name: str, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        entry = self.timings.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += time.perf_counter() - start
+        return result
+
+    def expect(self, what: str, actual, expected):
+        if actual != expected and isinstance(actual, dict) and isinstance(
+                expected, dict):
+            # Only the entries that differ
+            keys = {k for k in actual.keys() | expected.keys()
+                    if actual.get(k) != expected.get(k)}
+            actual = {k: actual.get(k) for k in keys}
+            expected = {k: expected.get(k) for k in keys}
+        elif actual != expected and isinstance(actual, list) and isinstance(
+                expected, list):
+            # From the first difference on
+            first = next((i for i, (a, b) in enumerate(zip(actual, expected))
+                          if a != b), min(len(actual), len(expected)))
+            what = f"{what} (from position {first})"
+            actual = actual[first:first + 5]
+            expected = expected[first:first + 5]
+        if actual != expected:
+            raise Mismatch(f"{what}:\n  real:  {actual!r}\n"
+                           f"  model: {expected!r}")
+
+    def grow_other(self):
+        # New notes in the second notebook, some linked to names that may
+        # or may not exist in the book under test
+        other, rnd = self.books.other, self.rnd
+        for _ in range(rnd.randint(1, 3)):
+            note = other.add_note(" ".join(self.generator.text()))
+            tags = [self.generator.tag() for _ in range(rnd.randint(0, 2))]
+            if tags:
+                other.add_tags(note.id.value, tags)
+            for _ in range(rnd.randint(0, 2)):
+                other.link(note.id.value, rnd.choice(self.generator.names))
+            self.model.other.append({
+                "id": note.id.value, "text": note.text.value,
+                "tags": [t.value for t in note.tags],
+                "contacts": list(note.contacts)})
+
+    def step(self, command: str, args):
+        if command == "merge-notes" and self.rnd.random() < 0.7:
+            self.grow_other()
+        method = getattr(self.model, command.replace("-", "_"))
+        before = self.model._state()
+        self.model.recorded = True
+        try:
+            expected = method(args)
+            if self.model.recorded:
+                self.model._recorded(before)
+        except Rejected as e:
+            expected = str(e)
+            self.rejected[command] += 1
+        actual = self.timed(command, self.books.run, command, args)
+        if command in ("undo", "redo") and expected is None:
+            # The reply names the command; only its prefix is predicted
+            prefix = "Undone: " if command == "undo" else "Redone: "
+            self.expect(command, actual[:len(prefix)], prefix)
+        else:
+            self.expect(f"{command} {' '.join(args)}", actual, expected)
+
+    def check_queries(self):
+        model, books, rnd = self.model, self.books, self.rnd
+
+        name = self.generator.name()
+        record = self.timed("?find", books.address_book.find, name)
+        display = model.find(name)
+        self.expect(f"find {name!r}",
+                    record and (record.name.value, contact_state(record)),
+                    display and (display, model.contacts[display]))
+
+        tags = [self.generator.tag() for _ in range(rnd.randint(1, 2))]
+        notes = self.timed("?search_by_tags", books.note_book.search_by_tags,
+                           tags)
+        self.expect(f"search_by_tags {tags}", [n.id.value for n in notes],
+                    model.search_by_tags(tags))
+
+        notes = self.timed("?sort_by_tags", books.note_book.sort_by_tags)
+        self.expect("sort_by_tags", [n.id.value for n in notes],
+                    model.sort_by_tags())
+
+        days = rnd.randint(1, 60)
+        today = date(rnd.randint(2023, 2028), 1, 1) + timedelta(
+            days=rnd.randrange(366))
+        region = rnd.choice([None, "us", "gb", "de"])
+        found = self.timed("?get_upcoming_birthdays",
+                           books.address_book.get_upcoming_birthdays,
+                           days, today, region)
+        self.expect(f"get_upcoming_birthdays {days} {today} {region}",
+                    [(b["congratulation_date"], b["name"]) for b in found],
+                    model.upcoming_birthdays(days, today, region))
+
+    def check_state(self):
+        model, books = self.model, self.books
+        address_book, note_book = books.address_book, books.note_book
+
+        self.expect("contacts",
+                    {n: contact_state(r) for n, r in address_book.items()},
+                    model.contacts)
+        self.expect("notes",
+                    {n.id.value: note_state(n) for n in note_book.get_notes()},
+                    model.notes)
+        self.expect("next note id", note_book.next_id, model.next_id)
+        for name in model.contacts:
+            linked = sorted(i for i, n in model.notes.items()
+                            if name in n["contacts"])
+            self.expect(f"notes_for {name}",
+                        [n.id.value for n in note_book.notes_for(name)],
+                        linked)
+
+        cache = books.cache
+        self.expect("all (cached)", h.show_all(address_book, cache),
+                    h.show_all(address_book))
+        self.expect("notes (cached)", h.show_notes(note_book, cache),
+                    h.show_notes(note_book))
+        self.expect("sort-notes-by-tags (cached)",
+                    h.sort_notes_by_tags([], note_book, cache),
+                    h.sort_notes_by_tags([], note_book))
+        region = books.settings.region
+        self.expect("birthdays (cached)",
+                    h.birthdays(["30"], address_book, 7, cache, region),
+                    h.birthdays(["30"], address_book, 7, None, region))
+
+        completion = books.completion
+        limit = completion.MAX_CANDIDATES
+        self.expect("name candidates", completion.names(""),
+                    sorted(model.contacts,
+                           key=lambda n: (normalize_name(n), n))[:limit])
+        self.expect("tag candidates", completion.tags(""),
+                    sorted(set().union(
+                        *(n["tags"] for n in model.notes.values())))[:limit])
+        self.expect("book region", books.settings.region, model.region)
+
+    def run(self):
+        for i in range(1, self.commands + 1):
+            command, args = self.generator.command()
+            self.recent.append(f"{command} {' '.join(args)}")
+            try:
+                self.step(command, args)
+                if i % self.every == 0:
+                    self.check_queries()
+                if i % (self.every * 10) == 0 or i == self.commands:
+                    self.check_state()
+            except Mismatch as e:
+                print(f"MISMATCH at command {i} (seed {self.seed}): {e}")
+                print("Last commands:")
+                for line in self.recent:
+                    print(f"  {line}")
+                return False
+        return True
+
+    def report(self):
+        print(f"{self.commands} commands, seed {self.seed}: "
+              f"{len(self.model.contacts)} contacts, "
+              f"{len(self.model.notes)} notes at the end")
+        print(f"{'operation':<24}{'calls':>8}{'rejected':>10}{'ops/s':>12}")
+        total_calls = total_time = 0
+        for name, (calls, seconds) in sorted(self.timings.items()):
+            print(f"{name:<24}{calls:>8}{self.rejected[name]:>10}"
+                  f"{calls / seconds if seconds else 0:>12.0f}")
+            if not name.startswith("?"):
+                total_calls += calls
+                total_time += seconds
+        print(f"{'commands total':<24}{total_calls:>8}"
+              f"{sum(self.rejected.values()):>10}"
+              f"{total_calls / total_time if total_time else 0:>12.0f}")
+
+
+def main():
+    commands = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    every = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    checker = Checker(commands, seed, every)
+    ok = checker.run()
+    checker.report()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
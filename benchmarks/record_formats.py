@@ -0,0 +1,95 @@
+# Load/save time of the versioned JSON record format against pickled
+# Record objects, plus a randomized round-trip check of the serializers.
+#
+# Run from the repository root:
+#     python benchmarks/record_formats.py [records] [rounds]
+
+import pickle
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from serialization import (  # noqa: E402
+    SCHEMA_VERSION,
+    decode_record,
+    decode_state,
+    encode_record,
+    encode_state,
+    note_to_dict,
+    record_to_dict,
+)
+from note_book import NoteBook  # noqa: E402
+from storage_codecs import make_records  # noqa: E402
+
+ALPHABET = "abcXYZ 019-|\"\\іé\U0001f600"
+
+
+def random_text(rnd: random.Random) -> str:
+    text = "".join(rnd.choice(ALPHABET) for _ in range(rnd.randint(1, 20)))
+    return text.strip() or "x"
+
+
+def check_round_trip(rounds: int):
+    rnd = random.Random(7)
+    for record in make_records(rounds):
+        if rnd.random() < 0.5:
+            record.add_address(random_text(rnd))
+        restored = decode_record(encode_record(record), SCHEMA_VERSION)
+        assert record_to_dict(restored) == record_to_dict(record)
+        assert str(restored) == str(record)
+
+    note_book = NoteBook()
+    for _ in range(rounds):
+        note = note_book.add_note(random_text(rnd))
+        note_book.add_tags(note.id.value,
+                           [random_text(rnd) for _ in range(rnd.randint(0, 3))])
+        if rnd.random() < 0.2:
+            note_book.delete_note(note.id.value)
+    payload = {"note_book": note_book, "birthdays_days": rnd.randint(1, 30)}
+    restored, _ = decode_state(list(encode_state(payload)),
+                               SCHEMA_VERSION)
+    assert restored["birthdays_days"] == payload["birthdays_days"]
+    assert restored["note_book"].next_id == note_book.next_id
+    assert ([note_to_dict(n) for n in restored["note_book"].get_notes()]
+            == [note_to_dict(n) for n in note_book.get_notes()])
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    check_round_trip(rounds)
+    print(f"round trip: {rounds} records and notes OK")
+
+    records = make_records(count)
+    print(f"{count} records")
+    print("(pickle* = one pickle for the whole book)")
+    print(f"{'format':<8}{'bytes':>12}{'save ms':>10}{'load ms':>10}")
+
+    items, save_ms = timed(lambda: [encode_record(r) for r in records])
+    _, load_ms = timed(
+        lambda: [decode_record(i, SCHEMA_VERSION) for i in items])
+    print(f"{'json':<8}{sum(map(len, items)):>12}{save_ms:>10.1f}"
+          f"{load_ms:>10.1f}")
+
+    items, save_ms = timed(lambda: [pickle.dumps(r) for r in records])
+    _, load_ms = timed(lambda: [pickle.loads(i) for i in items])
+    print(f"{'pickle':<8}{sum(map(len, items)):>12}{save_ms:>10.1f}"
+          f"{load_ms:>10.1f}")
+
+    # The whole book as one pickle, as the single-file state used to be
+    blob, save_ms = timed(lambda: pickle.dumps(records))
+    _, load_ms = timed(lambda: pickle.loads(blob))
+    print(f"{'pickle*':<8}{len(blob):>12}{save_ms:>10.1f}{load_ms:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# Size vs. save/load time of a contact segment for each state codec, and
+# how many records of a full segment one flipped byte costs.
+#
+# Run from the repository root:
+#     python benchmarks/storage_codecs.py [records]
+
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from address_book import Record  # noqa: E402
+from serialization import decode_record, encode_record  # noqa: E402
+from storage import BookStore, decode_frames, encode_frames  # noqa: E402
+
+CASES = [("none", 0), ("zlib", 1), ("zlib", 6), ("zlib", 9),
+         ("lzma", 0), ("lzma", 6)]
+
+
+def make_records(count: int):
+    rnd = random.Random(42)
+    records = []
+    for i in range(count):
+        record = Record(f"Contact {i:07d}")
+        for _ in range(rnd.randint(1, 3)):
+            try:
+                record.add_phone(f"{rnd.randrange(10 ** 10):010d}")
+            except ValueError:
+                pass
+        if rnd.random() < 0.6:
+            record.add_birthday(
+                f"{rnd.randint(1, 28):02d}.{rnd.randint(1, 12):02d}."
+                f"{rnd.randint(1950, 2010)}")
+        if rnd.random() < 0.4:
+            record.add_address(f"Kyiv, Street {rnd.randint(1, 500)}")
+        records.append(record)
+    return records
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    records = make_records(count)
+    print(f"{count} records")
+    segment = [encode_record(r) for r in records[:BookStore.SHARD_SIZE]]
+    print(f"{'codec':<8}{'level':>6}{'bytes':>12}{'save ms':>10}"
+          f"{'load ms':>10}{'lost':>8}")
+    for codec, level in CASES:
+        start = time.perf_counter()
+        items = [encode_record(r) for r in records]
+        data = b"".join(encode_frames(items, codec, level))
+        save_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        loaded, damaged, schema = decode_frames(data)
+        restored = [decode_record(item, schema) for item in loaded]
+        load_ms = (time.perf_counter() - start) * 1000
+        assert not damaged and len(restored) == count
+
+        # Records of a full segment lost to one byte flipped mid-file
+        damaged = bytearray(b"".join(encode_frames(segment, codec, level)))
+        damaged[len(damaged) // 2] ^= 0xFF
+        lost = len(segment) - len(decode_frames(bytes(damaged))[0])
+
+        print(f"{codec:<8}{level:>6}{len(data):>12}{save_ms:>10.1f}"
+              f"{load_ms:>10.1f}{lost:>8}")
+
+
+if __name__ == "__main__":
+    main()
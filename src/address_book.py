@@ -1,15 +1,27 @@
-from fields import Name, Phone, Birthday, Address
+from fields import Name, Phone, Birthday, Address, normalize_name
 from collections import UserDict
-from datetime import date, timedelta
+from datetime import date
 import calendar
+import time
+import calendars
+import events as ev
 
 
 class Record:
+    # EventBus of the book holding the record; set by AddressBook
+    events = None
+    # Time of the last change; 0 for records saved before stamps existed
+    modified = 0.0
+    # Holiday region for congratulation dates; None: the book's region
+    region = None
+
     def __init__(self, name: str):
         self.name = Name(name)
         self.phones = []
         self.birthday = None
         self.address = None
+        self.region = None
+        self.modified = time.time()
 
     def __str__(self):
         phones_str = ("; ".join(p.value for p in self.phones)
@@ -21,18 +33,26 @@ class Record:
             f"birthday: {birthday_str}, address: {address_str}"
         )
 
+    def _changed(self, kind: str, **data):
+        # Stamps the record and reports the change
+        self.modified = time.time()
+        if self.events is not None:
+            self.events.emit(kind, self.name.value, **data)
+
     def add_phone(self, phone_number: str):
         phone = self.find_phone(phone_number)
         if phone is not None:
             raise ValueError("Phone number already exists.")
         phone = Phone(phone_number)
         self.phones.append(phone)
+        self._changed(ev.PHONE_ADDED, phone=phone.value)
 
     def remove_phone(self, phone_number: str):
         phone = self.find_phone(phone_number)
         if phone is None:
             raise ValueError("Phone number not found.")
         self.phones.remove(phone)
+        self._changed(ev.PHONE_REMOVED, phone=phone.value)
 
     def find_phone(self, phone_number: str):
         return next(
@@ -43,51 +63,309 @@ class Record:
         phone = self.find_phone(phone_number)
         if phone is None:
             raise ValueError("Phone number not found.")
+        if (new_phone_number != phone_number
+                and self.find_phone(new_phone_number) is not None):
+            raise ValueError("Phone number already exists.")
         phone.value = new_phone_number
+        self._changed(ev.PHONE_EDITED, old=phone_number, phone=phone.value)
 
     def add_birthday(self, birthday_str: str):
         self.birthday = Birthday(birthday_str)
+        self._changed(ev.BIRTHDAY_SET, birthday=str(self.birthday))
+
+    def remove_birthday(self):
+        if self.birthday is not None:
+            self.birthday = None
+            self._changed(ev.BIRTHDAY_REMOVED)
 
     def add_address(self, address_str: str):
         self.address = Address(address_str)
+        self._changed(ev.ADDRESS_SET, address=self.address.value)
+
+    def remove_address(self):
+        if self.address is not None:
+            self.address = None
+            self._changed(ev.ADDRESS_REMOVED)
+
+    def set_region(self, region: str = None):
+        # region must be a known calendar code; None uses the book's
+        if region is not None:
+            calendars.get_calendar(region)
+            region = region.lower()
+        self.region = region
+        self._changed(ev.REGION_SET, region=region)
+
+    def snapshot(self) -> dict:
+        # Field values carried by contact-added events
+        return {
+            "phones": [p.value for p in self.phones],
+            "birthday": str(self.birthday) if self.birthday else None,
+            "address": self.address.value if self.address else None,
+        }
+
+    def merge(self, other: "Record"):
+        # Adds the other record's phones; birthday and address are only
+        # taken when missing here. Returns the fields whose values differed.
+        conflicts = []
+        for phone in other.phones:
+            if self.find_phone(phone.value) is None:
+                self.phones.append(Phone.trusted(phone.value))
+                self._changed(ev.PHONE_ADDED, phone=phone.value)
+        if other.birthday is not None:
+            if self.birthday is None:
+                self.birthday = Birthday.trusted(other.birthday.value)
+                self._changed(ev.BIRTHDAY_SET, birthday=str(self.birthday))
+            elif self.birthday.value != other.birthday.value:
+                conflicts.append("birthday")
+        if other.address is not None:
+            if self.address is None:
+                self.address = Address.trusted(other.address.value)
+                self._changed(ev.ADDRESS_SET, address=self.address.value)
+            elif self.address.value != other.address.value:
+                conflicts.append("address")
+        return conflicts
 
 
 class AddressBook(UserDict):
+    # Backing segment store and the shards not yet read from it; class-level
+    # defaults keep books unpickled from older state files working
+    _store = None
+    _pending = frozenset()
+    # NoteBook whose contact links follow renames and deletes
+    note_book = None
+    # EventBus notified of contact changes; None disables events
+    events = None
+
+    def __init__(self, *args, **kwargs):
+        # Normalised name -> display name; records stay keyed by display
+        # name in self.data
+        self._keys = {}
+        # Normalised name -> the other display names with that key, which
+        # only books saved before names were normalised can hold ("john"
+        # and "John"). The first name in sort order owns the key, so which
+        # record a lookup finds does not depend on the order of loading
+        self._variants = {}
+        super().__init__(*args, **kwargs)
+
+    def attach(self, store, loaded: bool = False):
+        # Records are read from the store's segments on first access
+        self._store = store
+        self._pending = set() if loaded else set(range(store.shards))
+        if store.rehash:
+            # Segments sharded by an older key scheme: read them all now,
+            # they are redistributed on the next save
+            self.load_all()
+
+    def pending_shards(self):
+        # Shards still only on disk
+        return sorted(self._pending)
+
+    def name_snapshot(self):
+        # Callable listing every contact name as of now without loading
+        # the pending shards into the book: loaded names are copied here,
+        # the others are read from the segment files when it is called,
+        # which is safe from another thread
+        loaded = list(self.data)
+        pending = self.pending_shards()
+        store = self._store
+
+        def names():
+            found = list(loaded)
+            for shard in pending:
+                found.extend(store.segment_names(shard))
+            return found
+
+        return names
+
+    def loaded_shards(self):
+        if self._store is None:
+            return set()
+        return set(range(self._store.shards)) - self._pending
+
+    def _load_shard(self, shard: int):
+        if shard in self._pending:
+            records = self._store.load_segment(shard)
+            # Only counted as loaded once the read succeeded, so a failed
+            # read is never saved back as an empty segment
+            self._pending.discard(shard)
+            for name, record in records.items():
+                self[name] = record
+
+    def _ensure(self, key: str):
+        if self._pending:
+            self._load_shard(self._store.shard_of(key))
+
+    def _resolve(self, name: str):
+        # Display name of the record matching name: an exact match first,
+        # then the normalised key
+        if name in self.data:
+            return name
+        key = normalize_name(name)
+        self._ensure(key)
+        if name in self.data:
+            return name
+        return self._keys.get(key)
+
+    @property
+    def shard_count(self) -> int:
+        return self._store.shards if self._store is not None else 1
+
+    def shard_of(self, name: str) -> int:
+        if self._store is None:
+            return 0
+        return self._store.shard_of(normalize_name(name))
+
+    def load_changed_since(self, stamp: float):
+        # Loads the shards that may hold changes made after stamp and
+        # returns them together with the shards already in memory; every
+        # other shard is known to be unchanged
+        if self._store is None:
+            return {0}
+        for shard in self._store.changed_since(stamp) & self._pending:
+            self._load_shard(shard)
+        return self.loaded_shards()
+
+    def set_events(self, bus):
+        # Records loaded later pick the bus up in __setitem__
+        self.events = bus
+        for record in self.data.values():
+            record.events = bus
+
+    def load_all(self):
+        for shard in sorted(self._pending):
+            self._load_shard(shard)
+
+    def __setitem__(self, name, record):
+        self.data[name] = record
+        if self.events is not None:
+            record.events = self.events
+        key = normalize_name(name)
+        owner = self._keys.setdefault(key, name)
+        if owner != name:
+            names = self._variants.setdefault(key, set())
+            names.update((owner, name))
+            owner = self._keys[key] = min(names)
+            names.discard(owner)
+
+    def __delitem__(self, name):
+        del self.data[name]
+        key = normalize_name(name)
+        names = self._variants.get(key)
+        if self._keys.get(key) == name:
+            if names:
+                self._keys[key] = min(names)
+                names.discard(self._keys[key])
+            else:
+                del self._keys[key]
+        elif names:
+            names.discard(name)
+        if names is not None and not names:
+            del self._variants[key]
+
+    def __len__(self):
+        self.load_all()
+        return len(self.data)
+
+    def __iter__(self):
+        self.load_all()
+        return iter(self.data)
+
+    def values(self):
+        # Straight from the dict, skipping a key lookup per record
+        self.load_all()
+        return self.data.values()
+
+    def items(self):
+        self.load_all()
+        return self.data.items()
+
+    def __contains__(self, name):
+        return self._resolve(name) is not None
+
+    def __getitem__(self, name):
+        display = self._resolve(name)
+        if display is None:
+            raise KeyError(name)
+        return self.data[display]
+
     def add_record(self, record: Record):
-        self.data[record.name.value] = record
+        self._ensure(normalize_name(record.name.value))
+        self[record.name.value] = record
+        if self.events is not None and self.events.active:
+            self.events.emit(ev.CONTACT_ADDED, record.name.value,
+                             **record.snapshot())
 
     def find(self, name: str):
-        return self.data.get(name)
+        display = self._resolve(name)
+        return self.data[display] if display is not None else None
 
     def delete(self, name: str):
-        if name in self.data:
-            self.data.pop(name)
-        else:
+        display = self._resolve(name)
+        if display is None:
             raise KeyError("Contact not found.")
+        del self[display]
+        notes = []
+        if self.note_book is not None:
+            notes = self.note_book.drop_contact(display)
+        if self.events is not None:
+            self.events.emit(ev.CONTACT_DELETED, display, notes=notes)
 
-    def rename(self, old_name: str, new_name: str):
-        if old_name not in self.data:
+    def rename(self, old_name: str, new_name: str, restore: bool = False):
+        # restore: an undo putting back a name the record had before, which
+        # in an old book may share its key with another contact
+        old_display = self._resolve(old_name)
+        if old_display is None:
             raise KeyError("Contact not found.")
-        if new_name in self.data:
+        # A change of case or spacing only keeps the same key
+        new_display = self._resolve(new_name)
+        if (new_display is not None and new_display != old_display
+                and not (restore and new_name not in self.data)):
             raise ValueError("Contact with this name already exists.")
-        record = self.data.pop(old_name)
+        if new_name == old_display:
+            raise ValueError("New name must be different.")
+        record = self.data[old_display]
+        del self[old_display]
         record.name = Name(new_name)
-        self.data[new_name] = record
+        record.modified = time.time()
+        self[new_name] = record
+        notes = []
+        if self.note_book is not None:
+            notes = self.note_book.rename_contact(old_display, new_name)
+        if self.events is not None:
+            self.events.emit(ev.CONTACT_RENAMED, old_display, name=new_name,
+                             notes=notes)
+
+    def merge(self, target_name: str, source_name: str):
+        # Folds source into target and removes it; note links move along
+        target_display = self._resolve(target_name)
+        source_display = self._resolve(source_name)
+        if target_display is None or source_display is None:
+            raise KeyError("Contact not found.")
+        target = self.data[target_display]
+        conflicts = target.merge(self.data[source_display])
+        del self[source_display]
+        notes = []
+        if self.note_book is not None:
+            notes = self.note_book.rename_contact(source_display,
+                                                  target_display)
+        if self.events is not None:
+            self.events.emit(ev.CONTACT_MERGED, source_display,
+                             into=target_display, notes=notes)
+        return conflicts
 
-    def get_upcoming_birthdays(self, days: int = 7):
+    def get_upcoming_birthdays(self, days: int = 7, today: date = None,
+                               region: str = None):
+        # Congratulations move to the next workday of the contact's region
+        # (or the book's region): weekends and that region's holidays
         def clamp_to_month_end(year: int, month: int, day: int) -> date:
             last_day = calendar.monthrange(year, month)[1]
             return date(year, month, min(day, last_day))
 
-        def shift_to_workday(d: date) -> date:
-            # 5 = Saturday, 6 = Sunday
-            if d.weekday() == 5:
-                return d + timedelta(days=2)
-            if d.weekday() == 6:
-                return d + timedelta(days=1)
-            return d
+        book_calendar = calendars.get_calendar(region)
 
-        today = date.today()
+        self.load_all()
+        if today is None:
+            today = date.today()
         upcoming_birthdays = []
 
         for record in self.data.values():
@@ -109,7 +387,11 @@ class AddressBook(UserDict):
             days_remaining = (next_birthday - today).days
 
             if 0 <= days_remaining < days:
-                congratulation_date = shift_to_workday(next_birthday)
+                business = book_calendar
+                if record.region is not None:
+                    business = calendars.CALENDARS.get(record.region,
+                                                       book_calendar)
+                congratulation_date = business.next_workday(next_birthday)
                 upcoming_birthdays.append(
                     {
                         "name": record.name.value,
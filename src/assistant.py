@@ -1,7 +1,9 @@
 import pickle
+from collections import deque
 from pathlib import Path
 from address_book import AddressBook
 from note_book import NoteBook
+from storage import BookStore, write_atomic
 from handlers import (
     add_contact,
     show_phone,
@@ -22,7 +24,28 @@ from handlers import (
     sort_notes_by_tags,
     rename,
     set_birthdays_days,
+    set_region,
+    set_timezone,
+    show_stats,
+    search_books,
+    verify,
+    undo,
+    redo,
+    retag,
+    query_contacts,
+    link_note,
+    unlink_note,
+    notes_for,
+    dedupe,
+    export_vcard,
+    merge_notes,
+    show_history,
 )
+from events import EventBus, EventLog
+from completion import CompletionIndex
+from history import History
+from render_cache import RenderCache
+from profiling import PROFILER, TimedIO
 
 try:
     import readline  # stdlib: tab-completion on Unix/macOS
@@ -32,49 +55,194 @@ except Exception:
 
 class Assistant:
     DEFAULT_BIRTHDAYS_DAYS = 7
-
-    def __init__(self, filename: str = "assistant.pkl"):
-        # Store state under ~/.bot
+    DEFAULT_BOOK = "default"
+    EVENT_LOG = "events.jsonl"
+    HISTORY_FILE = "history"
+    HISTORY_SIZE = 1000
+
+    def __init__(self, book: str = DEFAULT_BOOK, profile: bool = False,
+                 codec: str = None, level: int = None, events: bool = False):
+        # Store state under ~/.bot; every named book gets its own directory
         self.state_dir = Path.home() / ".bot"
-        self.state_dir.mkdir(parents=True, exist_ok=True)
-        # Always store state file inside ~/.bot, using the base name to avoid
-        # directory traversal
-        self.filename = Path(filename).name
-        self.filepath = self.state_dir / self.filename
+        self.books_dir = self.state_dir / "books"
+        self.books_dir.mkdir(parents=True, exist_ok=True)
+        self.book = self.book_name(book)
+        self.store = BookStore(self.books_dir / self.book)
         self.address_book = None
         self.note_book = None
         self.birthdays_days = self.DEFAULT_BIRTHDAYS_DAYS
+        # Holiday region for congratulation dates and the book's time zone
+        # (None: weekends only, the host's local date)
+        self.region = None
+        self.timezone = None
+        self.history = History()
+        # Change events from both books; delivered once per command
+        self.events = EventBus()
+        # Output of the listing commands, kept in step by the events
+        self.render_cache = RenderCache()
+        self.events.subscribe(self.render_cache)
+        self.completion = CompletionIndex()
+        # Entered commands, newest last; kept in ~/.bot/history
+        self.input_history = deque(maxlen=self.HISTORY_SIZE)
+        if events:
+            self.events.subscribe(
+                EventLog(self.store.directory / self.EVENT_LOG))
+        self.codec = codec
+        self.level = level
+        self.profile = profile
+        if profile:
+            PROFILER.start(full=True)
+
+    @staticmethod
+    def book_name(name: str) -> str:
+        # The base name only, to avoid directory traversal; "." and ".."
+        # would still point at the books directory or its parent
+        name = Path(name).name
+        if name in ("", ".", ".."):
+            raise ValueError("Invalid book name.")
+        return name
+
+    def _load_legacy(self) -> bool:
+        # Single-file state written by earlier versions becomes the default
+        # book; it is saved in the segmented layout on exit
+        legacy = self.state_dir / "assistant.pkl"
+        if self.book != self.DEFAULT_BOOK or not legacy.is_file():
+            return False
+        with open(legacy, "rb") as f:
+            payload = pickle.load(f)
+        self.address_book = AddressBook(
+            payload.get("address_book") or {})
+        self.address_book.attach(self.store, loaded=True)
+        self.note_book = payload.get("note_book") or NoteBook()
+        self.birthdays_days = payload.get(
+            "birthdays_days", self.DEFAULT_BIRTHDAYS_DAYS
+        )
+        return True
 
     def _load_data(self):
-        try:
-            with open(self.filepath, "rb") as f:
-                payload = pickle.load(f)
-                self.address_book = payload.get(
-                    "address_book") or AddressBook()
-                self.note_book = payload.get("note_book") or NoteBook()
-                self.birthdays_days = payload.get(
-                    "birthdays_days", self.DEFAULT_BIRTHDAYS_DAYS
-                )
-        except FileNotFoundError:
+        with TimedIO("load", self.store.size):
+            self._load_book()
+        if self.codec is not None or self.level is not None:
+            # --level alone recompresses with the book's current codec
+            self.store.set_codec(self.codec or self.store.codec, self.level)
+
+    def _load_book(self):
+        if not self.store.exists():
+            if self._load_legacy():
+                return
             self.address_book = AddressBook()
+            self.address_book.attach(self.store, loaded=True)
             self.note_book = NoteBook()
             self.birthdays_days = self.DEFAULT_BIRTHDAYS_DAYS
+            return
+
+        self.store.load_manifest()
+        payload = self.store.load_state()
+        self.address_book = AddressBook()
+        self.address_book.attach(self.store)
+        self.note_book = payload.get("note_book") or NoteBook()
+        self.birthdays_days = payload.get(
+            "birthdays_days", self.DEFAULT_BIRTHDAYS_DAYS
+        )
+        self.region = payload.get("region")
+        self.timezone = payload.get("timezone")
 
     def _save_data(self):
         payload = {
-            "address_book": self.address_book,
             "note_book": self.note_book,
             "birthdays_days": self.birthdays_days,
+            "region": self.region,
+            "timezone": self.timezone,
         }
-        with open(self.filepath, "wb") as f:
-            pickle.dump(payload, f)
+        with TimedIO("save", self.store.size):
+            self.store.save_state(payload)
+            self.store.save_address_book(self.address_book)
+
+    def iter_books(self):
+        # The open book is searched in memory, the others read from disk
+        yield self.book, self.address_book
+        for name in BookStore.list_books(self.books_dir):
+            if name == self.book:
+                continue
+            store = BookStore(self.books_dir / name)
+            store.load_manifest()
+            book = AddressBook()
+            book.attach(store)
+            yield name, book
+
+    def open_note_book(self, name: str) -> NoteBook:
+        # Notes of another book, read from disk
+        name = self.book_name(name)
+        if name == self.book:
+            return self.note_book
+        store = BookStore(self.books_dir / name)
+        if not store.exists():
+            raise KeyError("Book not found.")
+        store.load_manifest()
+        return store.load_state().get("note_book") or NoteBook()
+
+    def saved_store(self, name: str) -> BookStore:
+        # Store of a book as saved on disk; the open book is saved first so
+        # its files include this session's changes
+        name = self.book_name(name)
+        if name == self.book:
+            self._save_data()
+            return self.store
+        store = BookStore(self.books_dir / name)
+        if not store.exists():
+            raise KeyError("Book not found.")
+        store.load_manifest()
+        return store
+
+    def _link_books(self):
+        # Renames and deletes in the address book keep note links in step
+        self.address_book.note_book = self.note_book
+        self.address_book.set_events(self.events)
+        self.note_book.events = self.events
+
+    def _report_warnings(self):
+        for warning in self.store.warnings:
+            print(f"Warning: {warning}")
+        self.store.warnings.clear()
+
+    def _load_history(self):
+        try:
+            with open(self.state_dir / self.HISTORY_FILE, "r",
+                      encoding="utf-8") as f:
+                self.input_history.extend(
+                    line.rstrip("\n") for line in f if line.strip())
+        except FileNotFoundError:
+            return
+        if readline is not None:
+            for entry in self.input_history:
+                readline.add_history(entry)
+
+    def _save_history(self):
+        # Plain lines rather than readline's own file format, which
+        # differs between GNU readline and libedit
+        text = "".join(entry + "\n" for entry in self.input_history)
+        write_atomic(self.state_dir / self.HISTORY_FILE,
+                     [text.encode("utf-8")])
+
+    def _remember(self, user_input: str):
+        entry = user_input.strip()
+        if entry and (not self.input_history
+                      or self.input_history[-1] != entry):
+            self.input_history.append(entry)
 
     def __enter__(self):
         self._load_data()
+        self._link_books()
+        self._load_history()
+        self._report_warnings()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.events.flush()
         self._save_data()
+        self._save_history()
+        if self.profile:
+            print(f"Profile written to {PROFILER.dump(self.state_dir)}")
         return False
 
     @staticmethod
@@ -84,10 +252,12 @@ class Assistant:
             "  hello\n"
             "      Greet the assistant.\n"
             "\n"
-            "  add <name> <phone>\n"
+            "  add <name> <phone> [<name> <phone> ...]\n"
             "      Add a new contact or add a new phone number to an existing"
             " contact.\n"
+            "      Several name/phone pairs are applied as one batch.\n"
             "      Example: add John 1234567890\n"
+            "      Example: add John 1234567890 Mary 0987654321\n"
             "\n"
             "  change <name> <old_phone> <new_phone>\n"
             "      Replace an existing phone number with a new one for the"
@@ -103,10 +273,33 @@ class Assistant:
             "      Example: phone John\n"
             "\n"
             "  all\n"
-            "      Show all contacts with their phone numbers and birthdays.\n"
+            "      Show all contacts with their phone numbers, birthdays,"
+            " addresses\n"
+            "      and the number of linked notes.\n"
+            "\n"
+            "  query [filters] [sort=[-]field] [limit=N] [cols=col1,col2]\n"
+            "      Show contacts matching all filters in the 'all' table"
+            " format.\n"
+            "      Filters: <field><op><value> with op one of = != > < >="
+            " <= ~ (contains);\n"
+            "      fields: name, phones, phones.count, birthday,"
+            " birthday.day,\n"
+            "      birthday.month, birthday.year, address. Quote values with"
+            " spaces.\n"
+            "      Example: query birthday.month=5 sort=name limit=10\n"
+            "      Example: query address~Kyiv phones.count>1"
+            " cols=name,phones\n"
+            "\n"
+            "  dedupe [--merge]\n"
+            "      List clusters of likely duplicate contacts (same name"
+            " ignoring case\n"
+            "      and spacing, same phone, or same birthday and first name)."
+            "\n"
+            "      With --merge, fold each cluster into its most complete"
+            " record.\n"
             "\n"
-            "  add-birthday <name> <DD.MM.YYYY>\n"
-            "      Add or update a contact's birthday.\n"
+            "  add-birthday <name> <DD.MM.YYYY> [<name> <DD.MM.YYYY> ...]\n"
+            "      Add or update a contact's birthday (several pairs allowed).\n"
             "      Example: add-birthday John 01.01.1990\n"
             "\n"
             "  show-birthday <name>\n"
@@ -124,6 +317,21 @@ class Assistant:
             "      Set the default number of days for the birthdays command.\n"
             "      Example: set-birthdays-days 14\n"
             "\n"
+            "  set-region <region> [name]\n"
+            "      Set the holiday calendar used to move congratulations off"
+            " weekends\n"
+            "      and public holidays: for the book, or for one contact"
+            " ('book'\n"
+            "      makes the contact follow the book again). Regions: none,"
+            " us, gb, de.\n"
+            "      Example: set-region gb\n"
+            "      Example: set-region de John\n"
+            "\n"
+            "  set-timezone <zone>\n"
+            "      Set the book's time zone (IANA name) used to decide"
+            " what 'today' is.\n"
+            "      Example: set-timezone Europe/Kyiv\n"
+            "\n"
             "  add-address <name> <address>\n"
             "      Add or update a contact's address.\n"
             "      Example: add-birthday John US, CA, Los Angeles,\n"
@@ -144,18 +352,46 @@ class Assistant:
             "      Edit a note by its id.\n"
             "      Example: edit-note 3 Buy oat milk instead\n"
             "\n"
-            "  delete-note <id>\n"
-            "      Delete a note by its id.\n"
+            "  Note selectors: <ids> is an id, a range or a list of both"
+            " (3, 1-5000, 1,4,10-20);\n"
+            "  --tag <tag> selects every note with that tag.\n"
+            "\n"
+            "  delete-note <ids> | delete-notes --tag <tag>\n"
+            "      Delete the selected notes.\n"
             "      Example: delete-note 2\n"
+            "      Example: delete-notes --tag tmp\n"
             "\n"
-            "  tag-note <id> <tag1> [tag2] ...\n"
-            "      Add one or more tags to a note.\n"
+            "  tag-note <ids|--tag tag> <tag1> [tag2] ...\n"
+            "      Add one or more tags to the selected notes.\n"
             "      Example: tag-note 1 shopping home\n"
+            "      Example: tag-note 1-5000 archive\n"
             "\n"
-            "  untag-note <id> <tag1> [tag2] ...\n"
-            "      Remove one or more tags from a note.\n"
+            "  untag-note <ids|--tag tag> <tag1> [tag2] ...\n"
+            "      Remove one or more tags from the selected notes.\n"
             "      Example: untag-note 1 home\n"
             "\n"
+            "  retag <old_tag> <new_tag>\n"
+            "      Replace a tag on every note that has it.\n"
+            "      Example: retag old new\n"
+            "\n"
+            "  link-note <ids|--tag tag> <name>\n"
+            "      Link the selected notes to a contact.\n"
+            "      Example: link-note 3 John\n"
+            "\n"
+            "  unlink-note <ids|--tag tag> <name>\n"
+            "      Remove the link between the selected notes and a contact.\n"
+            "      Example: unlink-note 3 John\n"
+            "\n"
+            "  notes-for <name>\n"
+            "      List the notes linked to a contact.\n"
+            "      Example: notes-for John\n"
+            "\n"
+            "  merge-notes <book>\n"
+            "      Import the notes of another book. They get new ids after"
+            " the\n"
+            "      existing ones; notes merged before are skipped.\n"
+            "      Example: merge-notes team\n"
+            "\n"
             "  find-notes <tag1> [tag2] ...\n"
             "      Find notes which contain at least one of the given tags.\n"
             "      Example: find-notes shopping home\n"
@@ -163,6 +399,43 @@ class Assistant:
             "  sort-notes-by-tags\n"
             "      Show all notes sorted by tags (alphabetically).\n"
             "\n"
+            "  undo\n"
+            "      Revert the last change to contacts or notes.\n"
+            "\n"
+            "  redo\n"
+            "      Re-apply the last undone change.\n"
+            "\n"
+            "  export-vcard <directory> | sync <directory>\n"
+            "      Mirror contacts into a directory, one .vcf file per"
+            " contact.\n"
+            "      Later runs only rewrite contacts changed since the last"
+            " sync\n"
+            "      and delete the files of removed contacts.\n"
+            "      Example: sync ~/contacts\n"
+            "\n"
+            "  history [text]\n"
+            "      Show previously entered commands (kept in ~/.bot/history),"
+            "\n"
+            "      or only those containing the text.\n"
+            "      Example: history add-note\n"
+            "\n"
+            "  search-books <text>\n"
+            "      Search contact names and phones across all books.\n"
+            "      Example: search-books john\n"
+            "\n"
+            "  verify [book] [--full]\n"
+            "      Check the saved contacts, notes and settings for corrupt"
+            " entries.\n"
+            "      Files unchanged since their last clean check are skipped;"
+            "\n"
+            "      --full checks everything again.\n"
+            "      Example: verify\n"
+            "\n"
+            "  stats [on|off|reset]\n"
+            "      Show per-command call counts and latency histograms.\n"
+            "      'on'/'off' toggle collection; run 'bot --profile' for a\n"
+            "      full cProfile/tracemalloc report written on exit.\n"
+            "\n"
             "  help\n"
             "      Show this help message.\n"
             "\n"
@@ -184,6 +457,11 @@ class Assistant:
         if readline is None:
             return
 
+        # Contact names are collected in the background
+        self.events.subscribe(self.completion)
+        self.completion.prefetch(self.address_book.name_snapshot(),
+                                 self.note_book.get_notes())
+
         # Known commands and those whose first argument is a contact name
         commands = [
             "hello",
@@ -192,24 +470,43 @@ class Assistant:
             "rename",
             "phone",
             "all",
+            "query",
+            "dedupe",
             "add-birthday",
             "show-birthday",
             "birthdays",
+            "set-region",
+            "set-timezone",
             "add-address",
             "show-address",
             "add-note",
             "notes",
             "edit-note",
             "delete-note",
+            "delete-notes",
             "tag-note",
             "untag-note",
+            "retag",
+            "link-note",
+            "unlink-note",
+            "notes-for",
+            "merge-notes",
             "find-notes",
             "sort-notes-by-tags",
+            "undo",
+            "redo",
+            "search-books",
+            "verify",
+            "history",
+            "export-vcard",
+            "sync",
+            "stats",
             "help",
             "exit",
             "close",
         ]
         name_first_cmds = {
+            "notes-for",
             "add",
             "change",
             "rename",
@@ -219,8 +516,20 @@ class Assistant:
             "add-address",
             "show-address",
         }
+        # Commands taking tags: the first argument position that is a tag
+        tag_cmds = {
+            "find-notes": 1,
+            "tag-note": 2,
+            "untag-note": 2,
+            "retag": 1,
+        }
+        # Candidates are computed once per completion (state 0) and then
+        # returned one by one
+        matches = []
 
         def completer(text, state):
+            if state > 0:
+                return matches[state] if state < len(matches) else None
             try:
                 buf = readline.get_line_buffer()
             except Exception:
@@ -247,16 +556,18 @@ class Assistant:
                     ) in name_first_cmds and token_index == 1
                 ):
                     # Completing the first argument (contact name)
-                    names = (list(self.address_book.data.keys())
-                             if self.address_book else [])
-                    candidates = self._match_candidates(names, text)
+                    candidates = self.completion.names(text)
+                elif (
+                    tokens[token_index - 1] == "--tag"
+                    or token_index >= tag_cmds.get(tokens[0].lower(),
+                                                   token_index + 1)
+                ):
+                    candidates = self.completion.tags(text)
                 else:
                     candidates = []
 
-            try:
-                return sorted(candidates)[state]
-            except IndexError:
-                return None
+            matches[:] = sorted(candidates)
+            return matches[0] if matches else None
 
         try:
             # Bind both GNU readline and libedit (macOS) styles
@@ -285,6 +596,7 @@ class Assistant:
         while True:
             try:
                 user_input = input("Enter a command: ")
+                self._remember(user_input)
                 command, *args = user_input.split()
                 command = command.strip().lower()
             except (EOFError, KeyboardInterrupt):
@@ -298,68 +610,126 @@ class Assistant:
                 print("Good bye!")
                 break
 
-            elif command == "help":
+            self.events.hold()
+            if command == "help":
                 print(self._help())
 
             elif command == "hello":
                 print("How can I help you?")
 
             elif command == "add":
-                print(add_contact(args, self.address_book))
+                print(add_contact(args, self.address_book, self.history))
 
             elif command == "change":
-                print(change_phone(args, self.address_book))
+                print(change_phone(args, self.address_book, self.history))
 
             elif command == "rename":
-                print(rename(args, self.address_book))
+                print(rename(args, self.address_book, self.history))
 
             elif command == "phone":
                 print(show_phone(args, self.address_book))
 
             elif command == "all":
-                print(show_all(self.address_book))
+                print(show_all(self.address_book, self.render_cache))
+
+            elif command == "query":
+                print(query_contacts(args, self.address_book))
+
+            elif command == "dedupe":
+                print(dedupe(args, self.address_book, self.history))
 
             elif command == "add-birthday":
-                print(add_birthday(args, self.address_book))
+                print(add_birthday(args, self.address_book, self.history))
 
             elif command == "show-birthday":
                 print(show_birthday(args, self.address_book))
 
             elif command == "birthdays":
-                print(birthdays(args, self.address_book, self.birthdays_days))
+                print(birthdays(args, self.address_book, self.birthdays_days,
+                                self.render_cache, self.region,
+                                self.timezone))
 
             elif command == "set-birthdays-days":
                 print(set_birthdays_days(args, self))
 
+            elif command == "set-region":
+                print(set_region(args, self, self.history))
+
+            elif command == "set-timezone":
+                print(set_timezone(args, self))
+
             elif command == "add-address":
-                print(add_address(args, self.address_book))
+                print(add_address(args, self.address_book, self.history))
 
             elif command == "show-address":
                 print(show_address(args, self.address_book))
 
             elif command == "add-note":
-                print(add_note(args, self.note_book))
+                print(add_note(args, self.note_book, self.history))
 
             elif command == "notes":
-                print(show_notes(self.note_book))
+                print(show_notes(self.note_book, self.render_cache))
 
             elif command == "edit-note":
-                print(edit_note(args, self.note_book))
+                print(edit_note(args, self.note_book, self.history))
 
-            elif command == "delete-note":
-                print(delete_note(args, self.note_book))
+            elif command in ["delete-note", "delete-notes"]:
+                print(delete_note(args, self.note_book, self.history))
 
             elif command == "tag-note":
-                print(tag_note(args, self.note_book))
+                print(tag_note(args, self.note_book, self.history))
 
             elif command == "untag-note":
-                print(untag_note(args, self.note_book))
+                print(untag_note(args, self.note_book, self.history))
+
+            elif command == "retag":
+                print(retag(args, self.note_book, self.history))
+
+            elif command == "link-note":
+                print(link_note(args, self.note_book, self.address_book,
+                                self.history))
+
+            elif command == "unlink-note":
+                print(unlink_note(args, self.note_book, self.address_book,
+                                  self.history))
+
+            elif command == "notes-for":
+                print(notes_for(args, self.note_book, self.address_book))
+
+            elif command == "merge-notes":
+                print(merge_notes(args, self, self.history))
 
             elif command == "find-notes":
                 print(find_notes(args, self.note_book))
 
             elif command == "sort-notes-by-tags":
-                print(sort_notes_by_tags(args, self.note_book))
+                print(sort_notes_by_tags(args, self.note_book,
+                                         self.render_cache))
+
+            elif command == "undo":
+                print(undo(args, self.history))
+
+            elif command == "redo":
+                print(redo(args, self.history))
+
+            elif command in ["export-vcard", "sync"]:
+                print(export_vcard(args, self.address_book, self.book))
+
+            elif command == "history":
+                print(show_history(args, self.input_history))
+
+            elif command == "search-books":
+                print(search_books(args, self))
+
+            elif command == "verify":
+                print(verify(args, self))
+
+            elif command == "stats":
+                print(show_stats(args, PROFILER))
 
             else:
                 self.invalid_input()
+
+            self.events.release()
+            # Segments are read lazily, so damage may surface mid-session
+            self._report_warnings()
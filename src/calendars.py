@@ -0,0 +1,195 @@
+from datetime import date, datetime, timedelta
+
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:  # Python < 3.9
+    ZoneInfo = None
+
+
+def easter(year: int) -> date:
+    # Western (Gregorian) Easter Sunday, anonymous Gregorian algorithm
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7  # noqa: E741
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+def nth_weekday(year: int, month: int, weekday: int, n: int) -> date:
+    # n-th given weekday (0 = Monday) of the month; n = -1 is the last one
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday - first.weekday()) % 7
+                                 + 7 * (n - 1))
+    last = (date(year + month // 12, month % 12 + 1, 1)
+            - timedelta(days=1))
+    return last - timedelta(days=(last.weekday() - weekday) % 7)
+
+
+class BusinessCalendar:
+    # Weekends only. Subclasses add public holidays by overriding
+    # _holidays_in(); the holidays of a year and the next-workday table are
+    # computed once per year and cached.
+    name = "Weekends only"
+    WEEKEND = (5, 6)
+
+    def __init__(self):
+        self._holidays = {}
+        self._next_workday = {}
+
+    def _holidays_in(self, year: int):
+        # Holidays defined by the rules of this year; observed days may
+        # fall into a neighbouring year
+        return ()
+
+    def holidays(self, year: int) -> frozenset:
+        days = self._holidays.get(year)
+        if days is None:
+            days = self._holidays[year] = frozenset(
+                d for y in (year - 1, year, year + 1)
+                for d in self._holidays_in(y) if d.year == year)
+        return days
+
+    def is_workday(self, d: date) -> bool:
+        return d.weekday() not in self.WEEKEND and d not in self.holidays(
+            d.year)
+
+    def next_workday(self, d: date) -> date:
+        # The day itself if it is a workday, else the first one after it
+        table = self._next_workday.get(d.year)
+        if table is None:
+            table = self._next_workday[d.year] = self._workday_table(d.year)
+        return table[d.toordinal() - date(d.year, 1, 1).toordinal()]
+
+    def _workday_table(self, year: int):
+        following = date(year + 1, 1, 1)
+        while not self.is_workday(following):
+            following += timedelta(days=1)
+        day = date(year, 12, 31)
+        table = []
+        while day.year == year:
+            if self.is_workday(day):
+                following = day
+            table.append(following)
+            day -= timedelta(days=1)
+        table.reverse()
+        return table
+
+
+def _observed_nearest(d: date) -> date:
+    # Saturday holidays are observed on Friday, Sunday ones on Monday
+    if d.weekday() == 5:
+        return d - timedelta(days=1)
+    if d.weekday() == 6:
+        return d + timedelta(days=1)
+    return d
+
+
+def _substituted(days):
+    # Weekend holidays move to the next weekday that is not a holiday
+    # already
+    taken = {d for d in days if d.weekday() < 5}
+    for d in sorted(d for d in days if d.weekday() >= 5):
+        while d.weekday() >= 5 or d in taken:
+            d += timedelta(days=1)
+        taken.add(d)
+    return taken
+
+
+class UnitedStatesCalendar(BusinessCalendar):
+    name = "United States (federal holidays)"
+
+    def _holidays_in(self, year: int):
+        fixed = [date(year, 1, 1), date(year, 7, 4), date(year, 11, 11),
+                 date(year, 12, 25)]
+        if year >= 2021:
+            fixed.append(date(year, 6, 19))
+        return [_observed_nearest(d) for d in fixed] + [
+            nth_weekday(year, 1, 0, 3),   # Martin Luther King Jr. Day
+            nth_weekday(year, 2, 0, 3),   # Washington's Birthday
+            nth_weekday(year, 5, 0, -1),  # Memorial Day
+            nth_weekday(year, 9, 0, 1),   # Labor Day
+            nth_weekday(year, 10, 0, 2),  # Columbus Day
+            nth_weekday(year, 11, 3, 4),  # Thanksgiving
+        ]
+
+
+class EnglandCalendar(BusinessCalendar):
+    # Regular bank holidays of England and Wales; one-off holidays
+    # proclaimed for single years are not included
+    name = "England and Wales (bank holidays)"
+
+    def _holidays_in(self, year: int):
+        sunday = easter(year)
+        return list(_substituted(
+            [date(year, 1, 1), date(year, 12, 25), date(year, 12, 26)])) + [
+            sunday - timedelta(days=2),   # Good Friday
+            sunday + timedelta(days=1),   # Easter Monday
+            nth_weekday(year, 5, 0, 1),   # Early May bank holiday
+            nth_weekday(year, 5, 0, -1),  # Spring bank holiday
+            nth_weekday(year, 8, 0, -1),  # Summer bank holiday
+        ]
+
+
+class GermanyCalendar(BusinessCalendar):
+    # Nationwide public holidays; holidays of individual states are not
+    # included
+    name = "Germany (nationwide holidays)"
+
+    def _holidays_in(self, year: int):
+        sunday = easter(year)
+        return [
+            date(year, 1, 1), date(year, 5, 1), date(year, 10, 3),
+            date(year, 12, 25), date(year, 12, 26),
+            sunday - timedelta(days=2),   # Good Friday
+            sunday + timedelta(days=1),   # Easter Monday
+            sunday + timedelta(days=39),  # Ascension Day
+            sunday + timedelta(days=50),  # Whit Monday
+        ]
+
+
+DEFAULT_REGION = "none"
+
+# Region code -> calendar; register_calendar() adds more
+CALENDARS = {
+    DEFAULT_REGION: BusinessCalendar(),
+    "us": UnitedStatesCalendar(),
+    "gb": EnglandCalendar(),
+    "de": GermanyCalendar(),
+}
+
+
+def register_calendar(region: str, calendar: BusinessCalendar):
+    CALENDARS[region.lower()] = calendar
+
+
+def get_calendar(region: str = None) -> BusinessCalendar:
+    calendar = CALENDARS.get((region or DEFAULT_REGION).lower())
+    if calendar is None:
+        raise ValueError(
+            f"Unknown region: {region}. Known regions: "
+            f"{', '.join(sorted(CALENDARS))}.")
+    return calendar
+
+
+def check_timezone(name: str) -> str:
+    if ZoneInfo is None:
+        raise ValueError("Time zones need Python 3.9 or newer.")
+    try:
+        ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown time zone: {name}.")
+    return name
+
+
+def today(timezone: str = None) -> date:
+    # Current date in the given IANA time zone, or the host's local date
+    if timezone is None or ZoneInfo is None:
+        return date.today()
+    return datetime.now(ZoneInfo(timezone)).date()
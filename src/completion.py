@@ -0,0 +1,123 @@
+import threading
+from bisect import bisect_left, insort
+
+import events as ev
+from fields import normalize_name
+
+
+class CompletionIndex:
+    # Completion candidates for contact names and note tags: sorted lists
+    # answered with a binary search and kept up to date by the change
+    # events, so a lookup never scans the books. Contact names are
+    # collected by a background thread from the segment files; events that
+    # arrive before it finishes are queued and replayed on top of that
+    # snapshot.
+    MAX_CANDIDATES = 200
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ready = False
+        self._queued = []
+        # Sorted (normalised name, display name) pairs
+        self._names = []
+        # Tag -> number of notes carrying it, and the tags in order
+        self._tag_counts = {}
+        self._tags = []
+
+    def prefetch(self, load_names, notes):
+        # load_names() runs in the background and returns the display
+        # names of every contact; note tags are counted right away since
+        # the notes are already in memory
+        for note in notes:
+            self._add_tags(t.value for t in note.tags)
+        thread = threading.Thread(target=self._build, args=(load_names,),
+                                  name="completion-prefetch", daemon=True)
+        thread.start()
+        return thread
+
+    def _build(self, load_names):
+        try:
+            names = sorted((normalize_name(n), n) for n in load_names())
+        except Exception:
+            # Completion is a convenience; a failed prefetch leaves names
+            # out of it
+            names = []
+        with self._lock:
+            self._names = names
+            for event in self._queued:
+                self._apply(event)
+            self._queued = []
+            self.ready = True
+
+    def __call__(self, events):
+        with self._lock:
+            if not self.ready:
+                self._queued.extend(events)
+                return
+            for event in events:
+                self._apply(event)
+
+    def _apply(self, event):
+        data = event.data
+        if event.kind == ev.CONTACT_ADDED:
+            self._add_name(event.key)
+        elif event.kind in (ev.CONTACT_DELETED, ev.CONTACT_MERGED):
+            self._remove_name(event.key)
+        elif event.kind == ev.CONTACT_RENAMED:
+            self._remove_name(event.key)
+            self._add_name(data["name"])
+        elif event.kind in (ev.NOTE_ADDED, ev.NOTE_TAGGED):
+            self._add_tags(data["tags"])
+        elif event.kind in (ev.NOTE_DELETED, ev.NOTE_UNTAGGED):
+            self._remove_tags(data["tags"])
+
+    def _add_name(self, name: str):
+        entry = (normalize_name(name), name)
+        i = bisect_left(self._names, entry)
+        if i == len(self._names) or self._names[i] != entry:
+            self._names.insert(i, entry)
+
+    def _remove_name(self, name: str):
+        entry = (normalize_name(name), name)
+        i = bisect_left(self._names, entry)
+        if i < len(self._names) and self._names[i] == entry:
+            del self._names[i]
+
+    def _add_tags(self, tags):
+        for tag in tags:
+            count = self._tag_counts.get(tag, 0)
+            if not count:
+                insort(self._tags, tag)
+            self._tag_counts[tag] = count + 1
+
+    def _remove_tags(self, tags):
+        for tag in tags:
+            count = self._tag_counts.get(tag, 0) - 1
+            if count > 0:
+                self._tag_counts[tag] = count
+            elif count == 0:
+                del self._tag_counts[tag]
+                del self._tags[bisect_left(self._tags, tag)]
+
+    def names(self, prefix: str):
+        key = normalize_name(prefix)
+        with self._lock:
+            i = bisect_left(self._names, (key,))
+            found = []
+            while (i < len(self._names) and self._names[i][0].startswith(key)
+                   and len(found) < self.MAX_CANDIDATES):
+                found.append(self._names[i][1])
+                i += 1
+        return found
+
+    def tags(self, prefix: str):
+        # Tags are stored in lower case
+        prefix = prefix.lower()
+        with self._lock:
+            i = bisect_left(self._tags, prefix)
+            found = []
+            while (i < len(self._tags) and self._tags[i].startswith(prefix)
+                   and len(found) < self.MAX_CANDIDATES):
+                found.append(self._tags[i])
+                i += 1
+        return found
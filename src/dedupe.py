@@ -0,0 +1,65 @@
+from fields import normalize_name
+
+
+def blocking_keys(record):
+    # Records sharing any key end up in the same cluster: the same
+    # normalised name, the same phone, or the same birthday together with
+    # the same first name
+    name = normalize_name(record.name.value)
+    keys = [("name", name)]
+    keys.extend(("phone", phone.value) for phone in record.phones)
+    if record.birthday is not None:
+        keys.append(("birthday", record.birthday.value,
+                     name.split(" ", 1)[0]))
+    return keys
+
+
+def find_duplicates(records):
+    # Union-find over the blocking keys: every record is compared with the
+    # first record seen for each of its keys instead of with every other
+    # record, so the pass is linear in the number of records. Only records
+    # that collide on some key enter the union-find structure.
+    parent = {}
+    reasons = {}
+    by_name = {}
+    first_with = {}
+
+    def root(name):
+        while parent.get(name, name) != name:
+            parent[name] = parent.get(parent[name], parent[name])
+            name = parent[name]
+        return name
+
+    for record in records:
+        name = record.name.value
+        for key in blocking_keys(record):
+            other = first_with.setdefault(key, record)
+            if other is record:
+                continue
+            by_name[name] = record
+            by_name[other.name.value] = other
+            reasons.setdefault(name, set()).add(key[0])
+            a, b = root(name), root(other.name.value)
+            if a != b:
+                parent[b] = a
+
+    clusters = {}
+    for name in by_name:
+        clusters.setdefault(root(name), []).append(name)
+
+    result = []
+    for names in clusters.values():
+        kinds = set()
+        for name in names:
+            kinds |= reasons.get(name, set())
+        result.append(([by_name[n] for n in sorted(names)], sorted(kinds)))
+    result.sort(key=lambda c: c[0][0].name.value.lower())
+    return result
+
+
+def pick_canonical(cluster):
+    # Keep the most complete record; ties go to the alphabetically first name
+    return min(cluster, key=lambda r: (-(len(r.phones)
+                                         + (r.birthday is not None)
+                                         + (r.address is not None)),
+                                       r.name.value))
@@ -0,0 +1,112 @@
+import json
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# Change event types. Contact events are keyed by the contact's display
+# name, note events by the note id.
+CONTACT_ADDED = "contact-added"
+CONTACT_DELETED = "contact-deleted"
+CONTACT_RENAMED = "contact-renamed"
+CONTACT_MERGED = "contact-merged"
+PHONE_ADDED = "phone-added"
+PHONE_REMOVED = "phone-removed"
+PHONE_EDITED = "phone-edited"
+BIRTHDAY_SET = "birthday-set"
+BIRTHDAY_REMOVED = "birthday-removed"
+ADDRESS_SET = "address-set"
+ADDRESS_REMOVED = "address-removed"
+REGION_SET = "region-set"
+NOTE_ADDED = "note-added"
+NOTE_EDITED = "note-edited"
+NOTE_DELETED = "note-deleted"
+NOTE_TAGGED = "note-tagged"
+NOTE_UNTAGGED = "note-untagged"
+NOTE_LINKED = "note-linked"
+NOTE_UNLINKED = "note-unlinked"
+
+# Contact events that add, remove or rename contacts
+CONTACT_SET_EVENTS = frozenset({CONTACT_ADDED, CONTACT_DELETED,
+                                CONTACT_RENAMED, CONTACT_MERGED})
+NOTE_EVENTS = frozenset({NOTE_ADDED, NOTE_EDITED, NOTE_DELETED, NOTE_TAGGED,
+                         NOTE_UNTAGGED, NOTE_LINKED, NOTE_UNLINKED})
+
+
+class Event:
+    def __init__(self, kind: str, key, data: dict):
+        self.kind = kind
+        self.key = key
+        self.data = data
+        self.time = time.time()
+
+    def to_dict(self) -> dict:
+        return {"time": self.time, "type": self.kind, "key": self.key,
+                **self.data}
+
+    def __repr__(self):
+        return f"Event({self.kind!r}, {self.key!r}, {self.data!r})"
+
+
+class EventBus:
+    # Subscribers are callables receiving a list of events. While a batch
+    # is open events are queued and delivered together when it closes, so
+    # a bulk command costs one delivery rather than one per change; with
+    # no subscribers emit() returns before building anything.
+    def __init__(self):
+        self._subscribers = []
+        self._pending = []
+        self._depth = 0
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    @property
+    def active(self) -> bool:
+        return bool(self._subscribers)
+
+    def emit(self, kind: str, key, **data):
+        if not self._subscribers:
+            return
+        self._pending.append(Event(kind, key, data))
+        if not self._depth:
+            self.flush()
+
+    def hold(self):
+        self._depth += 1
+
+    def release(self):
+        self._depth = max(self._depth - 1, 0)
+        if not self._depth:
+            self.flush()
+
+    @contextmanager
+    def batch(self):
+        self.hold()
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def flush(self):
+        if not self._pending:
+            return
+        events, self._pending = self._pending, []
+        for callback in list(self._subscribers):
+            callback(events)
+
+
+class EventLog:
+    # Subscriber appending each delivered batch to a JSON-lines file in a
+    # single write; external tools tail the file
+    def __init__(self, path: Path):
+        self.path = path
+
+    def __call__(self, events):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        lines = "".join(json.dumps(e.to_dict(), ensure_ascii=False) + "\n"
+                        for e in events)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
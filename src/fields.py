@@ -1,3 +1,4 @@
+import unicodedata
 from datetime import datetime
 
 
@@ -17,6 +18,18 @@ class Field:
     def __str__(self):
         return str(self.value)
 
+    @classmethod
+    def trusted(cls, value):
+        # Build a field from already validated data, skipping the setter
+        field = cls.__new__(cls)
+        field._value = value
+        return field
+
+
+def normalize_name(name: str) -> str:
+    # Lookup key for contact names: NFKC, case-folded, single spaces
+    return " ".join(unicodedata.normalize("NFKC", name).split()).casefold()
+
 
 class Name(Field):
     pass
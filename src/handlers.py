@@ -1,9 +1,17 @@
 from collections import defaultdict
-from datetime import datetime
+from datetime import date, datetime
 from functools import wraps
+from pathlib import Path
 
 from address_book import Record, AddressBook
+from fields import Phone, Birthday, NoteTag
 from note_book import NoteBook
+from calendars import check_timezone, get_calendar, today
+from dedupe import find_duplicates, pick_canonical
+from profiling import instrument
+from query import compile_query
+from vcard import sync_vcards
+from verify import verify_book
 
 
 def input_error(func):
@@ -26,26 +34,123 @@ def input_error(func):
     return wrapper
 
 
-@input_error
-def add_contact(args, book: AddressBook):
-    if len(args) < 2:
-        raise IndexError("Usage: add [name] [phone]")
+def _restore(record: Record, field: str, value):
+    # Put back a birthday/address value captured before it was changed
+    if value is None:
+        getattr(record, f"remove_{field}")()
+    else:
+        getattr(record, f"add_{field}")(value)
 
-    name, phone, *_ = args
 
-    record = book.find(name)
-    message = "Contact updated."
-    if record is None:
-        record = Record(name)
-        book.add_record(record)
-        message = "Contact added."
+def _record_steps(history, description: str, steps):
+    # steps: (undo, redo) pairs in the order they were applied; a batch is
+    # undone and redone as a single history entry
+    if history is None or not steps:
+        return
+
+    def undo_all():
+        for undo_step, _ in reversed(steps):
+            undo_step()
+
+    def redo_all():
+        for _, redo_step in steps:
+            redo_step()
+
+    history.record(description, undo_all, redo_all)
+
+
+def _rollback(steps):
+    for undo_step, _ in reversed(steps):
+        undo_step()
+
+
+def _pairs(args, usage: str):
+    # "name value [name value ...]"; as before several pairs were accepted,
+    # one pair followed by a single extra word ignores that word
+    if len(args) < 2 or (len(args) > 3 and len(args) % 2):
+        raise IndexError(usage)
+    if len(args) <= 3:
+        return [tuple(args[:2])]
+    return list(zip(args[::2], args[1::2]))
+
+
+def _parse_id_ranges(spec: str):
+    # "3", "1-5000" or a comma-separated list such as "1,4,10-20"
+    ranges = []
+    for part in spec.split(","):
+        first, sep, last = part.partition("-")
+        try:
+            first = int(first)
+            last = int(last) if sep else first
+        except ValueError:
+            raise ValueError("Note id must be an integer.")
+        if first < 1 or last < first:
+            raise ValueError(f"Invalid note id range: {part}")
+        ranges.append((first, last))
+    return ranges
+
+
+def _select_notes(args, book: NoteBook):
+    # Leading selector: note ids/ranges or "--tag <tag>"; returns the
+    # selected notes and the remaining arguments
+    if args[0] == "--tag":
+        if len(args) < 2:
+            raise IndexError("Usage: --tag [tag]")
+        notes = book.with_tag(args[1])
+        rest = args[2:]
+    else:
+        notes = book.select(_parse_id_ranges(args[0]))
+        rest = args[1:]
+    if not notes:
+        raise KeyError("Note not found.")
+    return notes, rest
 
-    if phone:
-        record.add_phone(phone)
 
-    return message
+def _count_message(message: str, count: int, noun: str = "notes") -> str:
+    if count == 1:
+        return f"{message}."
+    return f"{message} ({count} {noun})."
 
 
+@instrument
+@input_error
+def add_contact(args, book: AddressBook, history=None):
+    pairs = _pairs(args, "Usage: add [name] [phone] [[name] [phone] ...]")
+
+    # Validate every phone before touching the book
+    for _, phone in pairs:
+        Phone(phone)
+
+    steps = []
+    added = 0
+    try:
+        for name, phone in pairs:
+            record = book.find(name)
+            if record is None:
+                record = Record(name)
+                record.add_phone(phone)
+                book.add_record(record)
+                added += 1
+                steps.append((lambda n=name: book.delete(n),
+                              lambda r=record: book.add_record(r)))
+            else:
+                record.add_phone(phone)
+                steps.append(
+                    (lambda n=name, p=phone: book.find(n).remove_phone(p),
+                     lambda n=name, p=phone: book.find(n).add_phone(p)))
+    except (KeyError, ValueError):
+        _rollback(steps)
+        raise
+
+    _record_steps(history, "add " + " ".join(
+        f"{n} {p}" for n, p in pairs), steps)
+
+    if len(pairs) == 1:
+        return "Contact added." if added else "Contact updated."
+    return f"Contacts added: {added}, updated: {len(pairs) - added}."
+
+
+@instrument
 @input_error
 def show_phone(args, book: AddressBook):
     if len(args) < 1:
@@ -63,8 +168,9 @@ def show_phone(args, book: AddressBook):
     return ", ".join(phone.value for phone in record.phones)
 
 
+@instrument
 @input_error
-def change_phone(args, book: AddressBook):
+def change_phone(args, book: AddressBook, history=None):
     if len(args) < 3:
         raise IndexError("Usage: change [name] [old_phone] [new_phone]")
 
@@ -75,40 +181,75 @@ def change_phone(args, book: AddressBook):
         raise KeyError("Contact not found.")
 
     record.edit_phone(old_phone, new_phone)
+    if history is not None:
+        history.record(
+            f"change {name} {old_phone} {new_phone}",
+            lambda: book.find(name).edit_phone(new_phone, old_phone),
+            lambda: book.find(name).edit_phone(old_phone, new_phone))
     return "Phone number updated."
 
 
+@instrument
 @input_error
-def rename(args, book: AddressBook):
+def rename(args, book: AddressBook, history=None):
     if len(args) < 2:
         raise IndexError("Usage: rename [old_name] [new_name]")
     old_name, new_name, *_ = args
     if old_name == new_name:
         raise ValueError("New name must be different.")
+    # Undo restores the name as displayed, not as typed
+    record = book.find(old_name)
+    old_display = record.name.value if record is not None else old_name
     book.rename(old_name, new_name)
+    if history is not None:
+        history.record(f"rename {old_name} {new_name}",
+                       lambda: book.rename(new_name, old_display,
+                                           restore=True),
+                       lambda: book.rename(old_display, new_name))
     return "Contact renamed."
 
 
-@input_error
-def show_all(book: AddressBook):
-    if not book.data:
-        return "No contacts found."
+# Table columns: key -> (header, alignment, cell text from record and book)
+TABLE_COLUMNS = {
+    "name": ("Name", "left", lambda r, b: r.name.value),
+    "phones": ("Phones", "left",
+               lambda r, b: ", ".join(p.value for p in r.phones)
+               if r.phones else ""),
+    "birthday": ("Birthday", "center",
+                 lambda r, b: str(r.birthday) if r.birthday else ""),
+    "address": ("Address", "left",
+                lambda r, b: str(r.address) if r.address else ""),
+    "notes": ("Notes", "right",
+              lambda r, b: str(b.note_book.count_for(r.name.value))),
+}
+
+
+def default_columns(book: AddressBook):
+    # The linked-notes count needs the NoteBook attached to the book
+    columns = list(TABLE_COLUMNS)
+    if book.note_book is None:
+        columns.remove("notes")
+    return columns
+
 
-    records = sorted(book.values(), key=lambda r: r.name.value.lower())
+def render_table(records, book: AddressBook, columns=None, cache=None):
+    # With a RenderCache, cells and padded lines of unchanged records are
+    # reused instead of being rendered again
+    columns = tuple(columns or default_columns(book))
 
     def _esc(s: str) -> str:
         return s.replace("|", "\\|")
 
+    def _cells(r):
+        return [_esc(TABLE_COLUMNS[c][2](r, book)) for c in columns]
+
     # Build escaped rows
-    rows = []
-    for r in records:
-        name = _esc(r.name.value)
-        phones = _esc(", ".join(p.value for p in r.phones) if r.phones else "")
-        birthday = _esc(str(r.birthday) if r.birthday else "")
-        address = _esc(str(r.address) if r.address else "")
-        rows.append([name, phones, birthday, address])
+    if cache is None:
+        rows = [_cells(r) for r in records]
+    else:
+        rows = [cache.cells(r, columns, _cells) for r in records]
 
-    headers = ["Name", "Phones", "Birthday", "Address"]
+    headers = [TABLE_COLUMNS[c][0] for c in columns]
 
     # Calculate max widths per column (including headers)
     col_widths = [len(h) for h in headers]
@@ -120,7 +261,7 @@ def show_all(book: AddressBook):
     # Build header row with padding
     header_row = "| " + " | ".join(h.ljust(col_widths[i]) for i, h in enumerate(headers)) + " |"
 
-    # Build alignment/separator row (left, left, center, left)
+    # Build alignment/separator row (birthday centered, counts right)
     def _align(width, align="left"):
         # produce markdown alignment marker matching width
         if width < 3:
@@ -132,7 +273,7 @@ def show_all(book: AddressBook):
         else:
             return ":" + "-" * (width - 1)  # left
 
-    alignments = ["left", "left", "center", "left"]
+    alignments = [TABLE_COLUMNS[c][1] for c in columns]
     separator_row = "| " + " | ".join(_align(col_widths[i], alignments[i]) for i in range(len(col_widths))) + " |"
 
     # Build data rows with padding (center birthday for readability)
@@ -147,31 +288,153 @@ def show_all(book: AddressBook):
         else:
             return cell.ljust(width)
 
-    lines = [header_row, separator_row]
-    for row in rows:
+    def _line(row):
         padded = []
         for i, cell in enumerate(row):
             padded.append(_pad(cell, col_widths[i], alignments[i]))
-        lines.append("| " + " | ".join(padded) + " |")
+        return "| " + " | ".join(padded) + " |"
+
+    lines = [header_row, separator_row]
+    if cache is None:
+        lines.extend(_line(row) for row in rows)
+    else:
+        lines.extend(cache.line(r, col_widths, _line) for r in records)
 
     return "\n".join(lines)
 
 
+@instrument
 @input_error
-def add_birthday(args, book: AddressBook):
-    if len(args) < 2:
-        raise IndexError("Usage: add-birthday [name] [DD.MM.YYYY]")
+def show_all(book: AddressBook, cache=None):
+    if not book:
+        return "No contacts found."
 
-    name, birthday_str, *_ = args
+    def _sorted():
+        return sorted(book.values(), key=lambda r: r.name.value.lower())
 
-    record = book.find(name)
-    if record is None:
-        raise KeyError("Contact not found.")
+    if cache is None:
+        return render_table(_sorted(), book)
+    return cache.output(
+        "all", cache.contacts_version,
+        lambda: render_table(cache.output("all-order", cache.order_version,
+                                          _sorted),
+                             book, cache=cache))
 
-    record.add_birthday(birthday_str)
-    return "Birthday set."
 
+@instrument
+@input_error
+def query_contacts(args, book: AddressBook):
+    plan = compile_query(args)
+    if "notes" in (plan.columns or ()) and book.note_book is None:
+        raise ValueError("Notes are not available for this book.")
+    records = plan.execute(book)
+    if not records:
+        return "No contacts found."
+    return render_table(records, book, plan.columns)
+
+
+def _merge_steps(book: AddressBook, target: Record, source: Record):
+    # Merges source into target; returns an undo/redo pair restoring the
+    # exact phones, fields and note links that changed
+    target_name = target.name.value
+    source_name = source.name.value
+    phones_before = {p.value for p in target.phones}
+    birthday_before = str(target.birthday) if target.birthday else None
+    address_before = target.address.value if target.address else None
+    note_book = book.note_book
+    source_links = target_links = set()
+    if note_book is not None:
+        source_links = {n.id.value for n in note_book.notes_for(source_name)}
+        target_links = {n.id.value for n in note_book.notes_for(target_name)}
+
+    conflicts = book.merge(target_name, source_name)
+    phones_added = [p.value for p in target.phones
+                    if p.value not in phones_before]
+
+    def undo_step():
+        record = book.find(target_name)
+        for phone in phones_added:
+            record.remove_phone(phone)
+        _restore(record, "birthday", birthday_before)
+        _restore(record, "address", address_before)
+        book.add_record(source)
+        for note_id in source_links:
+            note_book.link(note_id, source_name)
+            if note_id not in target_links:
+                note_book.unlink(note_id, target_name)
+
+    def redo_step():
+        book.merge(target_name, source_name)
+
+    return conflicts, (undo_step, redo_step)
+
+
+@instrument
+@input_error
+def dedupe(args, book: AddressBook, history=None):
+    if args and args != ["--merge"]:
+        raise ValueError("Usage: dedupe [--merge]")
+    clusters = find_duplicates(book.values())
+    if not clusters:
+        return "No duplicate contacts found."
+
+    if not args:
+        lines = []
+        for i, (records, reasons) in enumerate(clusters, start=1):
+            names = ", ".join(r.name.value for r in records)
+            lines.append(f"{i}. {names} (same {', '.join(reasons)})")
+        lines.append(f"{len(clusters)} cluster(s). "
+                     "Run 'dedupe --merge' to merge them.")
+        return "\n".join(lines)
+
+    steps = []
+    lines = []
+    for records, _ in clusters:
+        target = pick_canonical(records)
+        for source in records:
+            if source is target:
+                continue
+            conflicts, step = _merge_steps(book, target, source)
+            steps.append(step)
+            if conflicts:
+                lines.append(f"{source.name.value} -> {target.name.value}: "
+                             f"kept {target.name.value}'s "
+                             f"{' and '.join(conflicts)}")
+    _record_steps(history, "dedupe --merge", steps)
+    lines.append(f"Merged {len(steps)} contact(s) into "
+                 f"{len(clusters)} record(s).")
+    return "\n".join(lines)
 
+
+@instrument
+@input_error
+def add_birthday(args, book: AddressBook, history=None):
+    pairs = _pairs(
+        args,
+        "Usage: add-birthday [name] [DD.MM.YYYY] [[name] [DD.MM.YYYY] ...]")
+
+    records = []
+    for name, birthday_str in pairs:
+        Birthday(birthday_str)
+        record = book.find(name)
+        if record is None:
+            raise KeyError("Contact not found.")
+        records.append(record)
+
+    steps = []
+    for record, (name, birthday_str) in zip(records, pairs):
+        old = str(record.birthday) if record.birthday else None
+        record.add_birthday(birthday_str)
+        steps.append(
+            (lambda n=name, o=old: _restore(book.find(n), "birthday", o),
+             lambda n=name, b=birthday_str: book.find(n).add_birthday(b)))
+
+    _record_steps(history, "add-birthday " + " ".join(
+        f"{n} {b}" for n, b in pairs), steps)
+    return _count_message("Birthday set", len(pairs), "contacts")
+
+
+@instrument
 @input_error
 def show_birthday(args, book: AddressBook):
     if len(args) < 1:
@@ -189,8 +452,10 @@ def show_birthday(args, book: AddressBook):
     return f"{name}: {record.birthday}"
 
 
+@instrument
 @input_error
-def birthdays(args, book: AddressBook, default_days: int = 7):
+def birthdays(args, book: AddressBook, default_days: int = 7, cache=None,
+              region: str = None, timezone: str = None):
     if args and len(args) > 0:
         try:
             days = int(args[0])
@@ -203,7 +468,18 @@ def birthdays(args, book: AddressBook, default_days: int = 7):
     else:
         days = default_days
 
-    upcoming = book.get_upcoming_birthdays(days)
+    current = today(timezone)
+    if cache is None:
+        return _render_birthdays(book, days, current, region)
+    # The result also depends on the current date and the book's region
+    return cache.output("birthdays",
+                        (cache.contacts_version, days, current, region),
+                        lambda: _render_birthdays(book, days, current, region))
+
+
+def _render_birthdays(book: AddressBook, days: int, current: date,
+                      region: str) -> str:
+    upcoming = book.get_upcoming_birthdays(days, current, region)
 
     if not upcoming:
         return f"No birthdays in the next {days} days."
@@ -224,8 +500,9 @@ def birthdays(args, book: AddressBook, default_days: int = 7):
     return "\n".join(lines)
 
 
+@instrument
 @input_error
-def add_address(args, book: AddressBook):
+def add_address(args, book: AddressBook, history=None):
     if len(args) < 2:
         raise IndexError("Usage: add-address [name] [address]")
 
@@ -235,10 +512,17 @@ def add_address(args, book: AddressBook):
     if record is None:
         raise KeyError("Contact not found.")
 
-    record.add_address(" ".join(address_list))
+    old = record.address.value if record.address else None
+    address = " ".join(address_list)
+    record.add_address(address)
+    if history is not None:
+        history.record(f"add-address {name}",
+                       lambda: _restore(book.find(name), "address", old),
+                       lambda: book.find(name).add_address(address))
     return "Address set."
 
 
+@instrument
 @input_error
 def show_address(args, book: AddressBook):
     if len(args) < 1:
@@ -256,27 +540,39 @@ def show_address(args, book: AddressBook):
     return f"{name}: {record.address}"
 
 
+@instrument
 @input_error
-def add_note(args, book: NoteBook):
+def add_note(args, book: NoteBook, history=None):
     if len(args) < 1:
         raise IndexError("Usage: add-note [text]")
     text = " ".join(args).strip()
     if not text:
         raise ValueError("Note text cannot be empty.")
     note = book.add_note(text)
+    if history is not None:
+        history.record(f"add-note {note.id.value}",
+                       lambda: book.delete_note(note.id.value),
+                       lambda: book.restore_note(note))
     return f"Note added with id {note.id.value}."
 
 
+@instrument
 @input_error
-def show_notes(book: NoteBook):
-    notes = book.get_notes()
-    if not notes:
-        return "No notes found."
-    return "\n".join(str(n) for n in notes)
-
-
+def show_notes(book: NoteBook, cache=None):
+    if cache is None:
+        notes = book.get_notes()
+        if not notes:
+            return "No notes found."
+        return "\n".join(str(n) for n in notes)
+    return cache.output(
+        "notes", cache.notes_version,
+        lambda: "\n".join(cache.note(n) for n in book.get_notes())
+        or "No notes found.")
+
+
+@instrument
 @input_error
-def edit_note(args, book: NoteBook):
+def edit_note(args, book: NoteBook, history=None):
     if len(args) < 2:
         raise IndexError("Usage: edit-note [id] [new text]")
     try:
@@ -286,54 +582,209 @@ def edit_note(args, book: NoteBook):
     new_text = " ".join(args[1:]).strip()
     if not new_text:
         raise ValueError("Note cannot be empty.")
+    note = book.find_note(note_id)
+    old_text = note.text.value if note else None
     book.edit_note(note_id, new_text)
+    if history is not None:
+        history.record(f"edit-note {note_id}",
+                       lambda: book.edit_note(note_id, old_text),
+                       lambda: book.edit_note(note_id, new_text))
     return "Note updated."
 
 
+@instrument
 @input_error
-def delete_note(args, book: NoteBook):
+def delete_note(args, book: NoteBook, history=None):
     if len(args) < 1:
-        raise IndexError("Usage: delete-note [id]")
-    try:
-        note_id = int(args[0])
-    except ValueError:
-        raise ValueError("Note id must be an integer.")
-    book.delete_note(note_id)
-    return "Note deleted."
-
-
+        raise IndexError("Usage: delete-note [id|ids|--tag tag]")
+    notes, _ = _select_notes(args, book)
+    ids = [n.id.value for n in notes]
+    deleted = book.delete_many(ids)
+    if history is not None:
+        history.record(f"delete-note {' '.join(args)}",
+                       lambda: book.restore_many(deleted),
+                       lambda: book.delete_many(ids))
+    return _count_message("Note deleted", len(deleted))
+
+
+def _tag_steps(book: NoteBook, changed: dict, added: bool):
+    # Undo/redo pair for the tags actually added to (or removed from) notes
+    def undo_step():
+        for note_id, tags in changed.items():
+            if added:
+                book.remove_tags(note_id, tags)
+            else:
+                book.add_tags(note_id, tags)
+
+    def redo_step():
+        for note_id, tags in changed.items():
+            if added:
+                book.add_tags(note_id, tags)
+            else:
+                book.remove_tags(note_id, tags)
+
+    return undo_step, redo_step
+
+
+@instrument
 @input_error
-def tag_note(args, book: NoteBook):
+def tag_note(args, book: NoteBook, history=None):
     if len(args) < 2:
-        raise IndexError("Usage: tag-note [id] [tag1] [tag2] ...")
-    try:
-        note_id = int(args[0])
-    except ValueError:
-        raise ValueError("Note id must be an integer.")
+        raise IndexError(
+            "Usage: tag-note [id|ids|--tag tag] [tag1] [tag2] ...")
+    notes, rest = _select_notes(args, book)
 
-    tags = [t.strip() for t in args[1:] if t.strip()]
+    tags = [t.strip() for t in rest if t.strip()]
     if not tags:
         raise ValueError("At least one tag is required.")
-    book.add_tags(note_id, tags)
-    return "Tags added."
+    changed = book.add_tags_many([n.id.value for n in notes], tags)
+    # Notes that already had every tag leave nothing to undo
+    if changed:
+        _record_steps(history, f"tag-note {' '.join(args)}",
+                      [_tag_steps(book, changed, added=True)])
+    return _count_message("Tags added", len(changed))
 
 
+@instrument
 @input_error
-def untag_note(args, book: NoteBook):
+def untag_note(args, book: NoteBook, history=None):
     if len(args) < 2:
-        raise IndexError("Usage: untag-note [id] [tag1] [tag2] ...")
-    try:
-        note_id = int(args[0])
-    except ValueError:
-        raise ValueError("Note id must be an integer.")
+        raise IndexError(
+            "Usage: untag-note [id|ids|--tag tag] [tag1] [tag2] ...")
+    notes, rest = _select_notes(args, book)
 
-    tags = [t.strip() for t in args[1:] if t.strip()]
+    tags = [t.strip() for t in rest if t.strip()]
     if not tags:
         raise ValueError("At least one tag is required.")
-    book.remove_tags(note_id, tags)
-    return "Tags removed."
+    changed = book.remove_tags_many([n.id.value for n in notes], tags)
+    if changed:
+        _record_steps(history, f"untag-note {' '.join(args)}",
+                      [_tag_steps(book, changed, added=False)])
+    return _count_message("Tags removed", len(changed))
 
 
+@instrument
+@input_error
+def retag(args, book: NoteBook, history=None):
+    if len(args) != 2:
+        raise IndexError("Usage: retag [old_tag] [new_tag]")
+    old_tag, new_tag = args
+    # Adding the new tag first would otherwise remove it again
+    if NoteTag(old_tag).value == NoteTag(new_tag).value:
+        raise ValueError("New tag must be different.")
+    notes = book.with_tag(old_tag)
+    if not notes:
+        raise KeyError("Note not found.")
+    ids = [n.id.value for n in notes]
+    added = book.add_tags_many(ids, [new_tag])
+    removed = book.remove_tags_many(ids, [old_tag])
+    if added or removed:
+        _record_steps(history, f"retag {old_tag} {new_tag}",
+                      [_tag_steps(book, added, added=True),
+                       _tag_steps(book, removed, added=False)])
+    return _count_message("Tag renamed", len(notes))
+
+
+def _link_steps(book: NoteBook, note_ids, name: str, linked: bool):
+    # Undo/redo pair for links actually created (or removed)
+    def undo_step():
+        for note_id in note_ids:
+            if linked:
+                book.unlink(note_id, name)
+            else:
+                book.link(note_id, name)
+
+    def redo_step():
+        for note_id in note_ids:
+            if linked:
+                book.link(note_id, name)
+            else:
+                book.unlink(note_id, name)
+
+    return undo_step, redo_step
+
+
+@instrument
+@input_error
+def link_note(args, note_book: NoteBook, address_book: AddressBook,
+              history=None):
+    if len(args) < 2:
+        raise IndexError("Usage: link-note [id|ids|--tag tag] [name]")
+    notes, rest = _select_notes(args, note_book)
+    record = address_book.find(rest[0] if rest else "")
+    if record is None:
+        raise KeyError("Contact not found.")
+    name = record.name.value
+
+    linked = [n.id.value for n in notes if note_book.link(n.id.value, name)]
+    if linked:
+        _record_steps(history, f"link-note {' '.join(args)}",
+                      [_link_steps(note_book, linked, name, linked=True)])
+    return _count_message(f"Linked to {name}", len(linked))
+
+
+def _linked_name(name: str, address_book: AddressBook) -> str:
+    # Links use the contact's display name
+    record = address_book.find(name)
+    return record.name.value if record is not None else name
+
+
+@instrument
+@input_error
+def unlink_note(args, note_book: NoteBook, address_book: AddressBook,
+                history=None):
+    if len(args) < 2:
+        raise IndexError("Usage: unlink-note [id|ids|--tag tag] [name]")
+    notes, rest = _select_notes(args, note_book)
+    name = _linked_name(rest[0] if rest else "", address_book)
+
+    unlinked = [n.id.value for n in notes
+                if note_book.unlink(n.id.value, name)]
+    if not unlinked:
+        raise ValueError(f"Note is not linked to {name}.")
+    _record_steps(history, f"unlink-note {' '.join(args)}",
+                  [_link_steps(note_book, unlinked, name, linked=False)])
+    return _count_message(f"Unlinked from {name}", len(unlinked))
+
+
+@instrument
+@input_error
+def notes_for(args, note_book: NoteBook, address_book: AddressBook):
+    if len(args) < 1:
+        raise IndexError("Usage: notes-for [name]")
+    name = _linked_name(args[0], address_book)
+    notes = note_book.notes_for(name)
+    if not notes:
+        return f"No notes linked to {name}."
+    return "\n".join(str(n) for n in notes)
+
+
+@instrument
+@input_error
+def merge_notes(args, assistant, history=None):
+    if len(args) != 1:
+        raise IndexError("Usage: merge-notes [book]")
+    other = assistant.open_note_book(args[0])
+    book = assistant.note_book
+    contacts = assistant.address_book
+
+    def resolve(name):
+        # Links survive only to contacts that exist in this book
+        record = contacts.find(name)
+        return record.name.value if record is not None else None
+
+    imported = book.merge(other, resolve)
+    if not imported:
+        return "No new notes to merge."
+    ids = [n.id.value for n in imported]
+    if history is not None:
+        history.record(f"merge-notes {args[0]}",
+                       lambda: book.delete_many(ids),
+                       lambda: book.restore_many(imported))
+    return f"Merged {len(imported)} note(s) as ids {ids[0]}-{ids[-1]}."
+
+
+@instrument
 @input_error
 def find_notes(args, book: NoteBook):
     if len(args) < 1:
@@ -348,16 +799,23 @@ def find_notes(args, book: NoteBook):
     return "\n".join(str(n) for n in notes)
 
 
+@instrument
 @input_error
-def sort_notes_by_tags(args, book: NoteBook):
+def sort_notes_by_tags(args, book: NoteBook, cache=None):
     if args:
         raise ValueError("Usage: sort-notes-by-tags")
-    notes = book.sort_by_tags()
-    if not notes:
-        return "No notes found."
-    return "\n".join(str(n) for n in notes)
-
-
+    if cache is None:
+        notes = book.sort_by_tags()
+        if not notes:
+            return "No notes found."
+        return "\n".join(str(n) for n in notes)
+    return cache.output(
+        "sort-notes-by-tags", cache.notes_version,
+        lambda: "\n".join(cache.note(n) for n in book.sort_by_tags())
+        or "No notes found.")
+
+
+@instrument
 @input_error
 def set_birthdays_days(args, assistant):
     if len(args) < 1:
@@ -372,3 +830,156 @@ def set_birthdays_days(args, assistant):
         if "positive" in str(e):
             raise
         raise ValueError("Number of days must be an integer.")
+
+
+@instrument
+@input_error
+def set_region(args, assistant, history=None):
+    if len(args) < 1:
+        raise IndexError("Usage: set-region [region] [name]")
+    region, *rest = args
+    if not rest:
+        get_calendar(region)
+        assistant.region = region.lower()
+        return f"Region set to {get_calendar(region).name}."
+
+    book = assistant.address_book
+    record = book.find(" ".join(rest))
+    if record is None:
+        raise KeyError("Contact not found.")
+    name = record.name.value
+    old = record.region
+    new = None if region.lower() == "book" else region
+    record.set_region(new)
+    if history is not None:
+        history.record(f"set-region {region} {name}",
+                       lambda: book.find(name).set_region(old),
+                       lambda: book.find(name).set_region(new))
+    if new is None:
+        return f"{name} follows the book's region."
+    return f"Region of {name} set to {get_calendar(new).name}."
+
+
+@instrument
+@input_error
+def set_timezone(args, assistant):
+    if len(args) != 1:
+        raise IndexError("Usage: set-timezone [zone]")
+    assistant.timezone = check_timezone(args[0])
+    return f"Time zone set to {args[0]} (today is {today(args[0]):%d.%m.%Y})."
+
+
+@input_error
+def undo(args, history):
+    if args:
+        raise ValueError("Usage: undo")
+    return f"Undone: {history.undo()}"
+
+
+@input_error
+def redo(args, history):
+    if args:
+        raise ValueError("Usage: redo")
+    return f"Redone: {history.redo()}"
+
+
+@instrument
+@input_error
+def search_books(args, assistant):
+    if len(args) < 1:
+        raise IndexError("Usage: search-books [text]")
+    needle = " ".join(args).strip().lower()
+    if not needle:
+        raise ValueError("Search text cannot be empty.")
+
+    lines = []
+    for book_name, book in assistant.iter_books():
+        for record in book.values():
+            if needle in record.name.value.lower() or any(
+                    needle in p.value for p in record.phones):
+                lines.append(f"[{book_name}] {record}")
+    if not lines:
+        return "No contacts found."
+    return "\n".join(lines)
+
+
+# Problems listed by verify; the rest are only counted
+MAX_PROBLEMS = 50
+
+
+@instrument
+@input_error
+def verify(args, assistant):
+    full = "--full" in args
+    names = [a for a in args if a != "--full"]
+    if len(names) > 1:
+        raise IndexError("Usage: verify [book] [--full]")
+    book_name = names[0] if names else assistant.book
+    report = verify_book(assistant.saved_store(book_name), full)
+
+    checked = report.files - report.unchanged
+    summary = f"Checked {checked} of {report.files} file(s) of '{book_name}'"
+    if checked:
+        # Counts cover the checked files only
+        summary += (f", holding {report.records} contact(s) and "
+                    f"{report.notes} note(s); {report.unchanged} unchanged "
+                    f"since the last check.")
+    else:
+        summary += "; all unchanged since the last check."
+    lines = [summary]
+    if not report.problems:
+        lines.append("No problems found.")
+        return "\n".join(lines)
+    lines.append(f"{len(report.problems)} problem(s):")
+    lines.extend(report.problems[:MAX_PROBLEMS])
+    if len(report.problems) > MAX_PROBLEMS:
+        lines.append(f"... and {len(report.problems) - MAX_PROBLEMS} more.")
+    return "\n".join(lines)
+
+
+@instrument
+@input_error
+def export_vcard(args, book: AddressBook, book_name: str):
+    if len(args) != 1:
+        raise IndexError("Usage: export-vcard [directory]")
+    directory = Path(args[0]).expanduser()
+    try:
+        written, deleted, total = sync_vcards(book, book_name, directory)
+    except OSError as e:
+        raise ValueError(f"Cannot sync to {directory}: {e.strerror}.")
+    return (f"Synced {total} contact(s) to {directory}: "
+            f"{written} written, {deleted} deleted.")
+
+
+@input_error
+def show_history(args, entries):
+    needle = " ".join(args).strip().lower()
+    numbered = [(i, entry) for i, entry in enumerate(entries, start=1)
+                if needle in entry.lower()]
+    if not numbered:
+        return "No matching commands." if needle else "History is empty."
+    return "\n".join(f"{i:>4}  {entry}" for i, entry in numbered)
+
+
+@input_error
+def show_stats(args, profiler):
+    if args:
+        action = args[0].lower()
+        if action == "on":
+            profiler.start()
+            return "Statistics collection enabled."
+        if action == "off":
+            profiler.stop()
+            return "Statistics collection disabled."
+        if action == "reset":
+            profiler.reset()
+            return "Statistics reset."
+        raise ValueError("Usage: stats [on|off|reset]")
+    if not profiler.enabled and not profiler.commands:
+        message = ("Statistics collection is off. "
+                   "Use 'stats on' or run 'bot --profile'.")
+        if profiler.io:
+            # Load/save timings are recorded regardless
+            message += "\n" + profiler.report()
+        return message
+    return profiler.report()
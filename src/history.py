@@ -0,0 +1,32 @@
+from collections import deque
+
+
+class History:
+    # Each entry stores only what one command changed, as a pair of
+    # callables that revert and re-apply it, so memory grows with the
+    # number of remembered commands rather than with the size of the books
+    DEFAULT_LIMIT = 100
+
+    def __init__(self, limit: int = DEFAULT_LIMIT):
+        self._undo = deque(maxlen=limit)
+        self._redo = deque(maxlen=limit)
+
+    def record(self, description: str, undo, redo):
+        self._undo.append((description, undo, redo))
+        self._redo.clear()
+
+    def undo(self) -> str:
+        if not self._undo:
+            raise ValueError("Nothing to undo.")
+        description, undo, _redo = self._undo[-1]
+        undo()
+        self._redo.append(self._undo.pop())
+        return description
+
+    def redo(self) -> str:
+        if not self._redo:
+            raise ValueError("Nothing to redo.")
+        description, _undo, redo = self._redo[-1]
+        redo()
+        self._undo.append(self._redo.pop())
+        return description
@@ -1,8 +1,52 @@
+import argparse
+
 from assistant import Assistant
+from storage import CODECS, DEFAULT_CODEC
+
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="bot", description="Address book CLI assistant bot.")
+    parser.add_argument(
+        "--book",
+        default=Assistant.DEFAULT_BOOK,
+        help="name of the address book to open (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--codec",
+        choices=sorted(CODECS),
+        help="compression codec for the book's state files "
+             f"(default for new books: {DEFAULT_CODEC})",
+    )
+    parser.add_argument(
+        "--level",
+        type=int,
+        choices=range(10),
+        metavar="0-9",
+        help="compression level (default: 6); without --codec it applies to "
+             "the book's current codec",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="collect per-command statistics and write a cProfile/"
+             "tracemalloc report to ~/.bot on exit",
+    )
+    parser.add_argument(
+        "--events",
+        action="store_true",
+        help="append every contact and note change to events.jsonl in the "
+             "book directory",
+    )
+    args = parser.parse_args(argv)
+    try:
+        Assistant.book_name(args.book)
+    except ValueError as e:
+        parser.error(str(e))
 
-def main():
-    with Assistant() as assistant:
+    with Assistant(book=args.book, profile=args.profile,
+                   codec=args.codec, level=args.level,
+                   events=args.events) as assistant:
         assistant.run()
 
 
@@ -1,20 +1,38 @@
+from bisect import bisect_left
 from typing import List
+from uuid import uuid4
 from fields import NoteID, NoteText, NoteTag
+import events as ev
 
 
 class Note:
+    # Global id ("<book uid>:<id>") of a note imported from another
+    # notebook; None for notes created in the notebook holding them
+    origin = None
+
     def __init__(self, note_id, text):
         self.id = NoteID(note_id)
         self.text = NoteText(text)
         self.tags = []
+        # Names of the contacts this note is about
+        self.contacts = []
+        self.origin = None
+
+    def __setstate__(self, state):
+        # Pickles from older versions have no contact links
+        self.__dict__.update(state)
+        self.__dict__.setdefault("contacts", [])
 
     def __str__(self):
+        text = f"[{self.id.value}] {self.text.value}"
         if self.tags:
             tags_str = ", ".join(
                 t.value for t in sorted(self.tags, key=lambda t: t.value)
             )
-            return f"[{self.id.value}] {self.text.value} (tags: {tags_str})"
-        return f"[{self.id.value}] {self.text.value}"
+            text += f" (tags: {tags_str})"
+        if self.contacts:
+            text += f" (contacts: {', '.join(sorted(self.contacts))})"
+        return text
 
     def add_tags(self, tags: List[NoteTag]):
         existing = {t.value for t in self.tags}
@@ -38,55 +56,366 @@ class Note:
 
 
 class NoteBook:
+    # EventBus notified of note changes; None disables events. Links
+    # moved by contact renames and deletes are listed in the contact
+    # events instead of being reported separately.
+    events = None
+    # Deleted notes leave a tombstone (None) in _notes; the list is
+    # compacted once tombstones outnumber live notes and this minimum
+    COMPACT_MIN = 1024
+
     def __init__(self):
+        # Identifies the notebook in the global ids of its notes
+        self.uid = uuid4().hex
+        # Notes in id order, with tombstones
         self._notes = []
+        self._index = {}
+        # Note id -> position in _notes, kept for tombstones until the
+        # next compaction so a restored note goes back to its slot
+        self._slot = {}
+        self._tombstones = 0
+        # Global ids of imported notes -> local id
+        self._origins = {}
+        # Reverse link index: contact name -> ids of notes linked to it
+        self._by_contact = {}
         self._note_id_counter = 1
 
+    def __setstate__(self, state):
+        # Pickles from older versions carry no indexes
+        self.__dict__.update(state)
+        self.__dict__.setdefault("uid", uuid4().hex)
+        self.load_notes(self._notes, self._note_id_counter)
+
+    @property
+    def next_id(self) -> int:
+        return self._note_id_counter
+
+    def load_notes(self, notes: List[Note], next_id: int):
+        self._notes = sorted(notes, key=lambda n: n.id.value)
+        self._index = {}
+        self._origins = {}
+        self._by_contact = {}
+        for note in self._notes:
+            self._add_to_index(note)
+        self._reslot()
+        self._note_id_counter = next_id
+
+    def _reslot(self):
+        self._slot = {n.id.value: i for i, n in enumerate(self._notes)}
+        self._tombstones = 0
+
+    def _live(self):
+        return (n for n in self._notes if n is not None)
+
+    def compact(self):
+        # Drops the tombstones; deleted notes can no longer be restored
+        # into their old slot afterwards
+        if self._tombstones:
+            self._notes = list(self._live())
+            self._reslot()
+
+    def _maybe_compact(self):
+        if self._tombstones > max(self.COMPACT_MIN, len(self._index)):
+            self.compact()
+
+    def _bury(self, note: Note):
+        self._notes[self._slot[note.id.value]] = None
+        self._tombstones += 1
+
+    def _place(self, note: Note):
+        # Back into its tombstone if it still has one, otherwise inserted
+        # in id order after a compaction
+        slot = self._slot.get(note.id.value)
+        if slot is not None and self._notes[slot] is None:
+            self._notes[slot] = note
+            self._tombstones -= 1
+            return
+        self.compact()
+        ids = [n.id.value for n in self._notes]
+        position = bisect_left(ids, note.id.value)
+        self._notes.insert(position, note)
+        for i in range(position, len(self._notes)):
+            self._slot[self._notes[i].id.value] = i
+
+    def global_id(self, note: Note) -> str:
+        return note.origin or f"{self.uid}:{note.id.value}"
+
+    def has_origin(self, origin: str) -> bool:
+        # True if a note with this global id is already in the notebook
+        if origin in self._origins:
+            return True
+        uid, _, note_id = origin.partition(":")
+        if uid != self.uid or not note_id.isdigit():
+            return False
+        note = self._index.get(int(note_id))
+        return note is not None and note.origin is None
+
+    def _emit(self, kind: str, note_id: int, **data):
+        if self.events is not None:
+            self.events.emit(kind, note_id, **data)
+
+    def _emit_added(self, note: Note):
+        if self.events is not None and self.events.active:
+            self.events.emit(ev.NOTE_ADDED, note.id.value,
+                             text=note.text.value,
+                             tags=[t.value for t in note.tags],
+                             contacts=list(note.contacts))
+
+    def _add_to_index(self, note: Note):
+        self._index[note.id.value] = note
+        if note.origin is not None:
+            self._origins[note.origin] = note.id.value
+        for name in note.contacts:
+            self._by_contact.setdefault(name, set()).add(note.id.value)
+
+    def _remove_from_index(self, note: Note):
+        del self._index[note.id.value]
+        if note.origin is not None:
+            self._origins.pop(note.origin, None)
+        for name in note.contacts:
+            ids = self._by_contact.get(name)
+            if ids is not None:
+                ids.discard(note.id.value)
+                if not ids:
+                    del self._by_contact[name]
+
     def add_note(self, text: str):
         note = Note(self._note_id_counter, text)
+        self._slot[note.id.value] = len(self._notes)
         self._notes.append(note)
+        self._add_to_index(note)
         self._note_id_counter += 1
+        self._emit_added(note)
         return note
 
+    def restore_note(self, note: Note):
+        # Put a deleted note back in id order, keeping its original id
+        self._place(note)
+        self._add_to_index(note)
+        self._note_id_counter = max(self._note_id_counter, note.id.value + 1)
+        self._emit_added(note)
+
     def get_notes(self):
-        return list(self._notes)
+        return list(self._live())
 
     def find_note(self, note_id):
-        return next(
-            (note for note in self._notes if note.id.value == note_id),
-            None)
+        return self._index.get(note_id)
+
+    def select(self, ranges) -> List[Note]:
+        # ranges: (first, last) id pairs, inclusive; short ranges are looked
+        # up in the index, long ones answered by one pass over the notes
+        total = sum(last - first + 1 for first, last in ranges)
+        if total <= len(self._index):
+            found = {}
+            for first, last in ranges:
+                for note_id in range(first, last + 1):
+                    note = self._index.get(note_id)
+                    if note is not None:
+                        found[note_id] = note
+            return sorted(found.values(), key=lambda n: n.id.value)
+        return [n for n in self._live()
+                if any(first <= n.id.value <= last
+                       for first, last in ranges)]
+
+    def with_tag(self, tag: str) -> List[Note]:
+        wanted = NoteTag(tag).value
+        return [n for n in self._live()
+                if any(t.value == wanted for t in n.tags)]
 
     def edit_note(self, note_id: int, new_text: str):
         note = self.find_note(note_id)
         if note is None:
             raise KeyError("Note not found.")
         note.text.value = new_text
+        self._emit(ev.NOTE_EDITED, note_id, text=new_text)
 
     def delete_note(self, note_id: int):
         note = self.find_note(note_id)
         if note is None:
             raise KeyError("Note not found.")
-        self._notes.remove(note)
+        self._bury(note)
+        self._remove_from_index(note)
+        self._emit(ev.NOTE_DELETED, note_id, contacts=list(note.contacts),
+                   tags=[t.value for t in note.tags])
+        self._maybe_compact()
+
+    def delete_many(self, note_ids) -> List[Note]:
+        # Each note leaves a tombstone; nothing is shifted
+        doomed = {i for i in note_ids if i in self._index}
+        deleted = [self._index[i] for i in sorted(doomed)]
+        for note in deleted:
+            self._bury(note)
+            self._remove_from_index(note)
+            self._emit(ev.NOTE_DELETED, note.id.value,
+                       contacts=list(note.contacts),
+                       tags=[t.value for t in note.tags])
+        self._maybe_compact()
+        return deleted
+
+    def restore_many(self, notes: List[Note]):
+        slots = [self._slot.get(n.id.value) for n in notes]
+        if all(s is not None and self._notes[s] is None for s in slots):
+            for note in notes:
+                self._place(note)
+        else:
+            # One merge of the sorted lists instead of an insert per note
+            self._notes = sorted(list(self._live()) + list(notes),
+                                 key=lambda n: n.id.value)
+            self._reslot()
+        for note in notes:
+            self._add_to_index(note)
+            self._emit_added(note)
+        if notes:
+            self._note_id_counter = max(
+                self._note_id_counter,
+                max(n.id.value for n in notes) + 1)
+
+    def merge(self, other: "NoteBook", resolve=None) -> List[Note]:
+        # Imports the notes of another notebook in one pass: ids are
+        # shifted by a single offset so the imported notes follow this
+        # notebook's ids in their original order, and notes imported before
+        # (same global id) are skipped. resolve maps a linked contact name
+        # to the name to link here, or to None to drop the link.
+        if other.uid == self.uid:
+            raise ValueError("Cannot merge a notebook into itself.")
+        incoming = [n for n in other.get_notes()
+                    if not self.has_origin(other.global_id(n))]
+        if not incoming:
+            return []
+        offset = self._note_id_counter - incoming[0].id.value
+        imported = []
+        for source in incoming:
+            note = Note.__new__(Note)
+            note.id = NoteID.trusted(source.id.value + offset)
+            note.text = NoteText.trusted(source.text.value)
+            note.tags = [NoteTag.trusted(t.value) for t in source.tags]
+            contacts = source.contacts
+            if resolve is not None:
+                contacts = [c for c in map(resolve, contacts) if c is not None]
+            note.contacts = list(dict.fromkeys(contacts))
+            note.origin = other.global_id(source)
+            imported.append(note)
+
+        for note in imported:
+            self._slot[note.id.value] = len(self._notes)
+            self._notes.append(note)
+            self._add_to_index(note)
+            self._emit_added(note)
+        self._note_id_counter = imported[-1].id.value + 1
+        return imported
 
     def add_tags(self, note_id: int, tags: List[str]):
         note = self.find_note(note_id)
         if note is None:
             raise KeyError("Note not found.")
         tag_objs: List[NoteTag] = [NoteTag(t) for t in tags]
+        before = len(note.tags)
         note.add_tags(tag_objs)
+        if len(note.tags) > before:
+            self._emit(ev.NOTE_TAGGED, note_id,
+                       tags=[t.value for t in note.tags[before:]])
 
     def remove_tags(self, note_id: int, tags: List[str]):
         note = self.find_note(note_id)
         if note is None:
             raise KeyError("Note not found.")
         tag_objs: List[NoteTag] = [NoteTag(t) for t in tags]
+        wanted = {t.value for t in tag_objs}
+        removed = [t.value for t in note.tags if t.value in wanted]
         note.remove_tags(tag_objs)
+        if removed:
+            self._emit(ev.NOTE_UNTAGGED, note_id, tags=removed)
+
+    def add_tags_many(self, note_ids, tags: List[str]):
+        # Returns {note_id: [tags actually added]} for notes that changed
+        tag_objs: List[NoteTag] = [NoteTag(t) for t in tags]
+        changed = {}
+        for note_id in note_ids:
+            note = self._index.get(note_id)
+            if note is None:
+                continue
+            before = len(note.tags)
+            note.add_tags(tag_objs)
+            if len(note.tags) > before:
+                changed[note_id] = [t.value for t in note.tags[before:]]
+                self._emit(ev.NOTE_TAGGED, note_id, tags=changed[note_id])
+        return changed
+
+    def remove_tags_many(self, note_ids, tags: List[str]):
+        # Returns {note_id: [tags actually removed]} for notes that changed
+        tag_objs: List[NoteTag] = [NoteTag(t) for t in tags]
+        wanted = {t.value for t in tag_objs}
+        changed = {}
+        for note_id in note_ids:
+            note = self._index.get(note_id)
+            if note is None:
+                continue
+            removed = [t.value for t in note.tags if t.value in wanted]
+            if removed:
+                note.remove_tags(tag_objs)
+                changed[note_id] = removed
+                self._emit(ev.NOTE_UNTAGGED, note_id, tags=removed)
+        return changed
+
+    def link(self, note_id: int, name: str) -> bool:
+        # Returns False if the note was already linked to the contact
+        note = self.find_note(note_id)
+        if note is None:
+            raise KeyError("Note not found.")
+        if name in note.contacts:
+            return False
+        note.contacts.append(name)
+        self._by_contact.setdefault(name, set()).add(note_id)
+        self._emit(ev.NOTE_LINKED, note_id, contact=name)
+        return True
+
+    def unlink(self, note_id: int, name: str) -> bool:
+        # Returns False if the note was not linked to the contact
+        note = self.find_note(note_id)
+        if note is None:
+            raise KeyError("Note not found.")
+        if name not in note.contacts:
+            return False
+        note.contacts.remove(name)
+        ids = self._by_contact[name]
+        ids.discard(note_id)
+        if not ids:
+            del self._by_contact[name]
+        self._emit(ev.NOTE_UNLINKED, note_id, contact=name)
+        return True
+
+    def notes_for(self, name: str) -> List[Note]:
+        ids = self._by_contact.get(name, ())
+        return [self._index[i] for i in sorted(ids)]
+
+    def count_for(self, name: str) -> int:
+        return len(self._by_contact.get(name, ()))
+
+    def rename_contact(self, old_name: str, new_name: str) -> List[int]:
+        # Only the notes linked to old_name are touched; returns their ids
+        ids = self._by_contact.pop(old_name, set())
+        target = self._by_contact.setdefault(new_name, set())
+        for note_id in ids:
+            contacts = self._index[note_id].contacts
+            contacts.remove(old_name)
+            if new_name not in contacts:
+                contacts.append(new_name)
+            target.add(note_id)
+        if not target:
+            del self._by_contact[new_name]
+        return sorted(ids)
+
+    def drop_contact(self, name: str) -> List[int]:
+        ids = self._by_contact.pop(name, set())
+        for note_id in ids:
+            self._index[note_id].contacts.remove(name)
+        return sorted(ids)
 
     def search_by_tags(self, tags: List[str]) -> List[Note]:
         tag_objs: List[NoteTag] = [NoteTag(t) for t in tags]
         if not tag_objs:
             return []
-        return [n for n in self._notes if n.has_any_tag(tag_objs)]
+        return [n for n in self._live() if n.has_any_tag(tag_objs)]
 
     def sort_by_tags(self) -> List[Note]:
         def key(note: Note) -> tuple[str, int]:
@@ -98,4 +427,4 @@ class NoteBook:
             first_tag = min(t.value for t in note.tags)
             return first_tag, note.id.value
 
-        return sorted(self._notes, key=key)
+        return sorted(self._live(), key=key)
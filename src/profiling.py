@@ -0,0 +1,162 @@
+import cProfile
+import io
+import pstats
+import time
+import tracemalloc
+from datetime import datetime
+from functools import wraps
+
+
+class CommandStats:
+    # Upper bounds (ms) of the latency histogram buckets; the last bucket
+    # collects everything slower than the largest bound
+    BUCKETS_MS = (0.1, 1, 10, 100, 1000)
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.alloc_bytes = 0
+        self.histogram = [0] * (len(self.BUCKETS_MS) + 1)
+
+    def add(self, seconds: float, alloc_bytes: int = 0):
+        self.calls += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.alloc_bytes += alloc_bytes
+        ms = seconds * 1000
+        for i, bound in enumerate(self.BUCKETS_MS):
+            if ms <= bound:
+                self.histogram[i] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.commands = {}
+        self.io = {}
+        self._profile = None
+
+    def start(self, full: bool = False):
+        # Counters alone are cheap; cProfile and tracemalloc only run for a
+        # full profiling session (bot --profile)
+        self.enabled = True
+        if full and self._profile is None:
+            tracemalloc.start()
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def stop(self):
+        self.enabled = False
+        if self._profile is not None:
+            self._profile.disable()
+
+    def reset(self):
+        self.commands = {}
+        self.io = {}
+
+    def record_command(self, name: str, seconds: float, alloc_bytes: int = 0):
+        stats = self.commands.get(name)
+        if stats is None:
+            stats = self.commands[name] = CommandStats()
+        stats.add(seconds, alloc_bytes)
+
+    def record_io(self, kind: str, seconds: float, size: int):
+        self.io[kind] = (seconds, size)
+
+    def report(self) -> str:
+        if not self.commands and not self.io:
+            return "No statistics recorded."
+
+        lines = []
+        if self.commands:
+            # Allocations are only measured while tracemalloc is tracing
+            # (bot --profile); without it the column would be all zeros
+            alloc = tracemalloc.is_tracing()
+            buckets = [f"<={b}ms" for b in CommandStats.BUCKETS_MS]
+            buckets.append(f">{CommandStats.BUCKETS_MS[-1]}ms")
+            lines.append(
+                "command               calls   avg ms   max ms  "
+                + ("alloc KiB  " if alloc else "")
+                + " ".join(b.rjust(8) for b in buckets)
+            )
+            for name in sorted(self.commands):
+                s = self.commands[name]
+                avg_ms = s.total / s.calls * 1000
+                lines.append(
+                    f"{name:<20} {s.calls:>6} {avg_ms:>8.3f} "
+                    f"{s.max * 1000:>8.3f}  "
+                    + (f"{s.alloc_bytes / 1024:>9.1f}  " if alloc else "")
+                    + " ".join(str(c).rjust(8) for c in s.histogram)
+                )
+        for kind in sorted(self.io):
+            seconds, size = self.io[kind]
+            lines.append(f"{kind}: {seconds * 1000:.3f} ms, {size} bytes")
+        return "\n".join(lines)
+
+    def dump(self, directory) -> str:
+        self.stop()
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = directory / f"profile-{stamp}.txt"
+        out = io.StringIO()
+        out.write(self.report() + "\n")
+        if self._profile is not None:
+            out.write("\n== cProfile (top 30 by cumulative time) ==\n")
+            pstats.Stats(self._profile, stream=out).sort_stats(
+                "cumulative").print_stats(30)
+            if tracemalloc.is_tracing():
+                out.write("\n== tracemalloc (top 20 allocation sites) ==\n")
+                snapshot = tracemalloc.take_snapshot()
+                for stat in snapshot.statistics("lineno")[:20]:
+                    out.write(f"{stat}\n")
+                tracemalloc.stop()
+            self._profile = None
+        path.write_text(out.getvalue(), encoding="utf-8")
+        return str(path)
+
+
+PROFILER = Profiler()
+
+
+def instrument(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not PROFILER.enabled:
+            return func(*args, **kwargs)
+
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            alloc = 0
+            if tracing:
+                alloc = max(tracemalloc.get_traced_memory()[0] - before, 0)
+            PROFILER.record_command(func.__name__, elapsed, alloc)
+
+    return wrapper
+
+
+class TimedIO:
+    # Context manager measuring a load/save of the state files; size is a
+    # callable returning their total size in bytes. Always recorded: the
+    # load runs before 'stats on' can be entered
+    def __init__(self, kind: str, size):
+        self.kind = kind
+        self.size = size
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            elapsed = time.perf_counter() - self.start
+            PROFILER.record_io(self.kind, elapsed, self.size())
+        return False
@@ -0,0 +1,173 @@
+import heapq
+import operator
+import re
+import shlex
+from datetime import datetime
+from itertools import islice
+
+from fields import normalize_name
+
+
+def _birthday(r):
+    return r.birthday.value if r.birthday else None
+
+
+def _birthday_part(part: str):
+    def get(r):
+        return getattr(r.birthday.value, part) if r.birthday else None
+    return get
+
+
+# Queryable fields: name -> (value getter, parser for literals)
+FIELDS = {
+    "name": (lambda r: r.name.value, str),
+    "phones": (lambda r: [p.value for p in r.phones], str),
+    "phones.count": (lambda r: len(r.phones), int),
+    "birthday": (_birthday,
+                 lambda s: datetime.strptime(s, "%d.%m.%Y").date()),
+    "birthday.day": (_birthday_part("day"), int),
+    "birthday.month": (_birthday_part("month"), int),
+    "birthday.year": (_birthday_part("year"), int),
+    "address": (lambda r: r.address.value if r.address else None, str),
+}
+
+COLUMNS = ("name", "phones", "birthday", "address", "notes")
+
+OPERATORS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    ">": operator.gt,
+    "<": operator.lt,
+    ">=": operator.ge,
+    "<=": operator.le,
+    "~": lambda value, wanted: wanted.lower() in value.lower(),
+}
+
+_TERM = re.compile(r"^([a-z.]+)(!=|>=|<=|=|>|<|~)(.*)$")
+
+
+class Filter:
+    def __init__(self, field: str, op: str, literal: str):
+        if field not in FIELDS:
+            raise ValueError(f"Unknown field: {field}")
+        getter, parse = FIELDS[field]
+        if op == "~" and parse is not str:
+            raise ValueError(f"'~' only applies to text fields, not {field}.")
+        try:
+            value = parse(literal)
+        except ValueError:
+            raise ValueError(f"Invalid value for {field}: {literal}")
+        self.field = field
+        self.op = op
+        self.value = value
+        self._get = getter
+        self._wanted = value
+        if field == "name" and op in ("=", "!="):
+            # Names are equal the way the book looks them up: regardless
+            # of case, Unicode form and repeated spaces
+            self._get = lambda r: normalize_name(r.name.value)
+            self._wanted = normalize_name(value)
+        self._compare = OPERATORS[op]
+
+    def _test(self, value) -> bool:
+        if value is None:
+            return self.op == "!="
+        return self._compare(value, self._wanted)
+
+    def __call__(self, record) -> bool:
+        value = self._get(record)
+        if isinstance(value, list):
+            # A multi-valued field matches if any of its values does
+            # ("!=" requires that none of them is equal)
+            if self.op == "!=":
+                return all(self._test(v) for v in value)
+            return any(self._test(v) for v in value)
+        return self._test(value)
+
+
+class Query:
+    # A compiled query: filters plus an access plan chosen once, before any
+    # record is read
+    def __init__(self, filters, sort=None, descending=False, limit=None,
+                 columns=None):
+        self.filters = filters
+        self.sort = sort
+        self.descending = descending
+        self.limit = limit
+        # None: the default table columns
+        self.columns = columns
+        # Exact-name filters are answered from the AddressBook key index;
+        # everything else is one streaming scan over the records
+        self.lookup = next((f for f in filters
+                            if f.field == "name" and f.op == "="), None)
+        self.residual = [f for f in filters if f is not self.lookup]
+
+    def _candidates(self, book):
+        if self.lookup is not None:
+            record = book.find(self.lookup.value)
+            return [record] if record is not None else []
+        return book.values()
+
+    def execute(self, book):
+        matches = (r for r in self._candidates(book)
+                   if all(f(r) for f in self.residual))
+
+        if self.sort is None:
+            return list(islice(matches, self.limit))
+
+        getter = FIELDS[self.sort][0]
+
+        def key(r):
+            value = getter(r)
+            if isinstance(value, list):
+                value = value[0] if value else None
+            if isinstance(value, str):
+                value = value.lower()
+            # Missing values sort last in either direction
+            return (value is None) != self.descending, value
+
+        if self.limit is not None:
+            pick = heapq.nlargest if self.descending else heapq.nsmallest
+            return pick(self.limit, matches, key=key)
+        return sorted(matches, key=key, reverse=self.descending)
+
+
+def compile_query(args) -> Query:
+    filters = []
+    options = {}
+    for term in shlex.split(" ".join(args)):
+        key, sep, value = term.partition("=")
+        if sep and key in ("sort", "limit", "cols"):
+            options[key] = value
+            continue
+        match = _TERM.match(term)
+        if match is None:
+            raise ValueError(f"Cannot parse query term: {term}")
+        filters.append(Filter(*match.groups()))
+
+    sort = options.get("sort")
+    descending = False
+    if sort:
+        descending = sort.startswith("-")
+        sort = sort.lstrip("-")
+        if sort not in FIELDS:
+            raise ValueError(f"Unknown sort field: {sort}")
+
+    limit = None
+    if "limit" in options:
+        try:
+            limit = int(options["limit"])
+        except ValueError:
+            raise ValueError("Limit must be an integer.")
+        if limit < 1:
+            raise ValueError("Limit must be positive.")
+
+    columns = None
+    if "cols" in options:
+        columns = [c.strip() for c in options["cols"].split(",") if c.strip()]
+        unknown = [c for c in columns if c not in COLUMNS]
+        if unknown or not columns:
+            raise ValueError(
+                f"Columns must be some of: {', '.join(COLUMNS)}.")
+
+    return Query(filters, sort, descending, limit, columns)
@@ -0,0 +1,78 @@
+import events as ev
+
+
+class RenderCache:
+    # EventBus subscriber caching the output of read-only listing commands.
+    # Each book has a version counter bumped by every change event; whole
+    # outputs are reused while their version is unchanged, and after an
+    # edit only the rows of the contacts and notes named in the events are
+    # rendered again.
+    def __init__(self):
+        self.contacts_version = 0
+        self.notes_version = 0
+        # Bumped when contacts are added, removed or renamed
+        self.order_version = 0
+        # Contact name -> [columns, cells, widths, line]
+        self._rows = {}
+        # Note id -> str(note)
+        self._notes = {}
+        # Command -> (key, value)
+        self._outputs = {}
+
+    def __call__(self, events):
+        for event in events:
+            data = event.data
+            if event.kind in ev.NOTE_EVENTS:
+                self.notes_version += 1
+                self._notes.pop(event.key, None)
+                # Linked contacts show the number of their notes
+                if "contact" in data:
+                    self._drop_row(data["contact"])
+                for name in data.get("contacts", ()):
+                    self._drop_row(name)
+            else:
+                if event.kind in ev.CONTACT_SET_EVENTS:
+                    self.order_version += 1
+                self._drop_row(event.key)
+                other = data.get("name") or data.get("into")
+                if other is not None:
+                    self._drop_row(other)
+                # Notes list the names of the contacts they are linked to
+                if data.get("notes"):
+                    self.notes_version += 1
+                    for note_id in data["notes"]:
+                        self._notes.pop(note_id, None)
+
+    def _drop_row(self, name: str):
+        self.contacts_version += 1
+        self._rows.pop(name, None)
+
+    def output(self, command: str, key, build):
+        # build() is only called when key differs from the cached one
+        cached = self._outputs.get(command)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        value = build()
+        self._outputs[command] = (key, value)
+        return value
+
+    def cells(self, record, columns: tuple, build):
+        row = self._rows.get(record.name.value)
+        if row is None or row[0] != columns:
+            row = self._rows[record.name.value] = [columns, build(record),
+                                                   None, None]
+        return row[1]
+
+    def line(self, record, widths: list, build):
+        # Padded table line; reused while the column widths stay the same
+        row = self._rows[record.name.value]
+        if row[2] != widths:
+            row[2] = widths
+            row[3] = build(row[1])
+        return row[3]
+
+    def note(self, note) -> str:
+        text = self._notes.get(note.id.value)
+        if text is None:
+            text = self._notes[note.id.value] = str(note)
+        return text
@@ -0,0 +1,136 @@
+import json
+from datetime import date
+
+from address_book import Record
+from fields import Phone, Birthday, Address, NoteID, NoteText, NoteTag
+from note_book import Note, NoteBook
+
+
+# Version of the dict layout written for records, notes and book state.
+# Schema 0 was the legacy layout of pickled items; it is never decoded,
+# pickle is only read from the ~/.bot/assistant.pkl of earlier releases.
+SCHEMA_VERSION = 5
+
+# MIGRATIONS[(kind, v)] turns a dict of schema v into schema v + 1
+MIGRATIONS = {
+    # 2: notes link to contacts
+    ("note", 1): lambda d: {**d, "contacts": []},
+    # 3: records carry a modification stamp (0: unknown)
+    ("record", 2): lambda d: {**d, "modified": 0.0},
+    # 4: notes record where they were imported from
+    ("note", 3): lambda d: {**d, "origin": None},
+    # 5: records may name a holiday region, books a region and time zone
+    # (optional keys, nothing to convert)
+}
+
+# What decoding a malformed item raises: bad JSON, a missing key or a
+# value of the wrong type
+DECODE_ERRORS = (ValueError, KeyError, TypeError, AttributeError)
+
+_dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+_loads = json.JSONDecoder().decode
+
+
+def migrate(kind: str, data: dict, schema: int) -> dict:
+    while schema < SCHEMA_VERSION:
+        step = MIGRATIONS.get((kind, schema))
+        if step is not None:
+            data = step(data)
+        schema += 1
+    return data
+
+
+def record_to_dict(record: Record) -> dict:
+    data = {"name": record.name.value,
+            "phones": [p.value for p in record.phones],
+            "modified": record.modified}
+    if record.birthday is not None:
+        data["birthday"] = record.birthday.value.isoformat()
+    if record.address is not None:
+        data["address"] = record.address.value
+    if record.region is not None:
+        data["region"] = record.region
+    return data
+
+
+def record_from_dict(data: dict) -> Record:
+    # Saved values were validated when they were entered, so fields are
+    # rebuilt without re-running the setters
+    record = Record(data["name"])
+    record.phones = [Phone.trusted(p) for p in data["phones"]]
+    if "birthday" in data:
+        record.birthday = Birthday.trusted(
+            date.fromisoformat(data["birthday"]))
+    if "address" in data:
+        record.address = Address.trusted(data["address"])
+    record.modified = data["modified"]
+    record.region = data.get("region")
+    return record
+
+
+def note_to_dict(note: Note) -> dict:
+    return {"id": note.id.value, "text": note.text.value,
+            "tags": [t.value for t in note.tags],
+            "contacts": list(note.contacts), "origin": note.origin}
+
+
+def note_from_dict(data: dict) -> Note:
+    note = Note.__new__(Note)
+    note.id = NoteID.trusted(data["id"])
+    note.text = NoteText.trusted(data["text"])
+    note.tags = [NoteTag.trusted(t) for t in data["tags"]]
+    note.contacts = list(data["contacts"])
+    note.origin = data["origin"]
+    return note
+
+
+def encode_record(record: Record) -> bytes:
+    return _dumps(record_to_dict(record)).encode("utf-8")
+
+
+def decode_record(item: bytes, schema: int) -> Record:
+    return record_from_dict(migrate("record", _loads(item.decode("utf-8")),
+                                    schema))
+
+
+def encode_state(payload: dict):
+    # First item holds the book settings, then one item per note
+    note_book = payload["note_book"]
+    header = {"birthdays_days": payload["birthdays_days"],
+              "next_note_id": note_book.next_id, "uid": note_book.uid,
+              "region": payload.get("region"),
+              "timezone": payload.get("timezone")}
+    yield _dumps(header).encode("utf-8")
+    for note in note_book.get_notes():
+        yield _dumps(note_to_dict(note)).encode("utf-8")
+
+
+def decode_state(items, schema: int):
+    # Returns (payload, number of items that could not be decoded); those
+    # are skipped so one bad note does not lose the rest of the book
+    if not items:
+        return {}, 0
+
+    header = {}
+    notes = []
+    failed = 0
+    for item in items:
+        try:
+            data = _loads(item.decode("utf-8"))
+            # Recovery from a damaged file may have lost the header item
+            if "id" in data:
+                notes.append(note_from_dict(migrate("note", data, schema)))
+            else:
+                header = dict(migrate("state", data, schema))
+        except DECODE_ERRORS:
+            failed += 1
+    next_id = max((n.id.value for n in notes), default=0) + 1
+    note_book = NoteBook()
+    note_book.load_notes(notes, max(header.get("next_note_id", 1), next_id))
+    if "uid" in header:
+        note_book.uid = header["uid"]
+    payload = {"note_book": note_book}
+    for key in ("birthdays_days", "region", "timezone"):
+        if key in header:
+            payload[key] = header[key]
+    return payload, failed
@@ -0,0 +1,382 @@
+import hashlib
+import json
+import lzma
+import os
+import shutil
+import struct
+import time
+import zlib
+from pathlib import Path
+
+from fields import normalize_name
+from serialization import (
+    DECODE_ERRORS,
+    SCHEMA_VERSION,
+    decode_record,
+    decode_state,
+    encode_record,
+    encode_state,
+)
+
+
+# Framed state file layout:
+#   header   MAGIC, format version, codec id, level, schema version of items
+#   chunks   CHUNK_TAG, raw length, compressed length, crc32 of the
+#            compressed bytes, compressed bytes
+#   trailer  END_TAG, number of chunks, crc32 of all raw bytes
+# A chunk holds whole length-prefixed items and is compressed on its own,
+# so a damaged chunk only loses the items inside it.
+MAGIC = b"BOTS"
+FORMAT_VERSION = 1
+CHUNK_TAG = b"CHNK"
+END_TAG = b"END!"
+CHUNK_SIZE = 16 * 1024
+
+_HEADER = struct.Struct(">4sBBBB")
+_CHUNK = struct.Struct(">4sIII")
+_TRAILER = struct.Struct(">4sII")
+_ITEM = struct.Struct(">I")
+
+CODECS = {"none": 0, "zlib": 1, "lzma": 2}
+DEFAULT_CODEC = "zlib"
+DEFAULT_LEVEL = 6
+
+
+def _compress(codec: int, level: int, raw: bytes) -> bytes:
+    if codec == CODECS["zlib"]:
+        return zlib.compress(raw, level)
+    if codec == CODECS["lzma"]:
+        return lzma.compress(raw, preset=level)
+    return raw
+
+
+def _decompress(codec: int, data: bytes) -> bytes:
+    if codec == CODECS["zlib"]:
+        return zlib.decompress(data)
+    if codec == CODECS["lzma"]:
+        return lzma.decompress(data)
+    return data
+
+
+def encode_frames(items, codec: str = DEFAULT_CODEC,
+                  level: int = DEFAULT_LEVEL, schema: int = SCHEMA_VERSION):
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec: {codec}")
+    codec_id = CODECS[codec]
+    yield _HEADER.pack(MAGIC, FORMAT_VERSION, codec_id, level, schema)
+
+    count = 0
+    total_crc = 0
+    buf = bytearray()
+
+    def flush():
+        raw = bytes(buf)
+        comp = _compress(codec_id, level, raw)
+        buf.clear()
+        return _CHUNK.pack(CHUNK_TAG, len(raw), len(comp),
+                           zlib.crc32(comp)) + comp, raw
+
+    for item in items:
+        buf += _ITEM.pack(len(item))
+        buf += item
+        if len(buf) >= CHUNK_SIZE:
+            chunk, raw = flush()
+            total_crc = zlib.crc32(raw, total_crc)
+            count += 1
+            yield chunk
+    if buf:
+        chunk, raw = flush()
+        total_crc = zlib.crc32(raw, total_crc)
+        count += 1
+        yield chunk
+    yield _TRAILER.pack(END_TAG, count, total_crc)
+
+
+def _split_items(raw: bytes):
+    items = []
+    pos = 0
+    while pos < len(raw):
+        (size,) = _ITEM.unpack_from(raw, pos)
+        pos += _ITEM.size
+        items.append(raw[pos:pos + size])
+        pos += size
+    return items
+
+
+def decode_frames(data: bytes):
+    # Returns (items, damaged, schema); damaged counts chunks that could not
+    # be read plus one if the trailer is missing or does not match
+    magic, version, codec, _level, schema = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a framed state file.")
+    if version > FORMAT_VERSION:
+        raise ValueError(f"Unsupported state file version {version}.")
+    if schema > SCHEMA_VERSION:
+        raise ValueError(f"Unsupported schema version {schema}.")
+    if schema == 0:
+        # Pickled items: unpickling a tampered file could run code
+        raise ValueError("Pickled items are not loaded from framed files.")
+
+    items = []
+    damaged = 0
+    count = 0
+    total_crc = 0
+    pos = _HEADER.size
+    while pos < len(data):
+        tag = data[pos:pos + 4]
+        if tag == END_TAG and pos + _TRAILER.size <= len(data):
+            _tag, expected, crc = _TRAILER.unpack_from(data, pos)
+            if not damaged and (expected != count or crc != total_crc):
+                damaged += 1
+            return items, damaged, schema
+        if tag == CHUNK_TAG and pos + _CHUNK.size <= len(data):
+            _tag, raw_len, comp_len, crc = _CHUNK.unpack_from(data, pos)
+            start = pos + _CHUNK.size
+            comp = data[start:start + comp_len]
+            if len(comp) == comp_len and zlib.crc32(comp) == crc:
+                try:
+                    raw = _decompress(codec, comp)
+                except (zlib.error, lzma.LZMAError):
+                    raw = None
+                if raw is not None and len(raw) == raw_len:
+                    items.extend(_split_items(raw))
+                    total_crc = zlib.crc32(raw, total_crc)
+                    count += 1
+                    pos = start + comp_len
+                    continue
+        # Damaged chunk: resynchronise on the next chunk or trailer tag
+        damaged += 1
+        nxt = [i for i in (data.find(CHUNK_TAG, pos + 1),
+                           data.find(END_TAG, pos + 1)) if i != -1]
+        if not nxt:
+            break
+        pos = min(nxt)
+    # Truncated file: no trailer
+    return items, damaged + 1, schema
+
+
+def write_atomic(path: Path, pieces):
+    # Write to a sibling temp file first so an interrupted save never leaves
+    # a half-written state file behind
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        for piece in pieces:
+            f.write(piece)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class BookStore:
+    MANIFEST = "manifest.json"
+    STATE = "state.bin"
+    # Target number of records per segment file before the book is resharded
+    SHARD_SIZE = 5000
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.shards = 1
+        self.codec = DEFAULT_CODEC
+        self.level = DEFAULT_LEVEL
+        # True while segments are still sharded by raw (not normalised) name
+        self.rehash = False
+        self.warnings = []
+        self._digests = {}
+        # Shard -> time its segment file was last rewritten
+        self.stamps = {}
+
+    @staticmethod
+    def list_books(root: Path):
+        if not root.is_dir():
+            return []
+        return sorted(p.name for p in root.iterdir()
+                      if (p / BookStore.MANIFEST).is_file())
+
+    def exists(self) -> bool:
+        return (self.directory / self.MANIFEST).is_file()
+
+    def shard_of(self, key: str) -> int:
+        # key is a normalised contact name
+        # crc32 rather than hash(): str hashes are randomized per process
+        return zlib.crc32(key.encode("utf-8")) % self.shards
+
+    def set_codec(self, codec: str, level: int = None):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec: {codec}")
+        if level is None:
+            level = DEFAULT_LEVEL
+        if not 0 <= level <= 9:
+            raise ValueError("Compression level must be between 0 and 9.")
+        if (codec, level) != (self.codec, self.level):
+            self.codec = codec
+            self.level = level
+            # Rewrite every loaded segment with the new codec
+            self._digests = {}
+
+    def _segment_path(self, shard: int) -> Path:
+        return self.directory / f"segment-{shard:04d}.bin"
+
+    def files(self):
+        # (path, shard) of the state file (shard None) and every segment
+        return [(self.directory / self.STATE, None)] + [
+            (self._segment_path(shard), shard)
+            for shard in range(self.shards)]
+
+    @staticmethod
+    def _digest(data: bytes) -> bytes:
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def size(self) -> int:
+        if not self.directory.is_dir():
+            return 0
+        return sum(p.stat().st_size for p in self.directory.iterdir()
+                   if p.is_file())
+
+    def load_manifest(self):
+        with open(self.directory / self.MANIFEST, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        self.shards = manifest.get("shards", 1)
+        self.codec = manifest.get("codec", DEFAULT_CODEC)
+        self.level = manifest.get("level", DEFAULT_LEVEL)
+        self.rehash = manifest.get("keys") != "normalized" and self.shards > 1
+        self.stamps = {shard: stamp for shard, stamp
+                       in enumerate(manifest.get("stamps", ()))
+                       if stamp is not None}
+
+    def _save_manifest(self):
+        manifest = {"shards": self.shards, "codec": self.codec,
+                    "level": self.level, "keys": "normalized",
+                    "stamps": [self.stamps.get(shard)
+                               for shard in range(self.shards)]}
+        write_atomic(self.directory / self.MANIFEST,
+                     [json.dumps(manifest).encode("utf-8")])
+
+    def _read(self, path: Path):
+        # Returns (items, schema, damaged): the decoded items of a framed
+        # file, their schema version and whether anything was lost
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return [], SCHEMA_VERSION, False
+        try:
+            items, damaged, schema = decode_frames(data)
+        except (ValueError, struct.error) as e:
+            self._set_aside(path, f"unreadable ({e})", 0)
+            return [], SCHEMA_VERSION, True
+        if damaged:
+            self._set_aside(path, f"{damaged} damaged chunk(s)", len(items))
+        return items, schema, bool(damaged)
+
+    def _set_aside(self, path: Path, problem: str, recovered: int):
+        # Keep a copy of the damaged file: the next save of the book
+        # replaces it with what could be recovered. The original stays in
+        # place, so reading another book's files never empties that book
+        backup = path.with_name(path.name + ".damaged")
+        if path.exists():
+            shutil.copyfile(path, backup)
+        self.warnings.append(
+            f"{path.name}: {problem}, recovered {recovered} item(s); "
+            f"original kept as {backup.name}.")
+
+    def _write(self, path: Path, items):
+        write_atomic(path, encode_frames(items, self.codec, self.level))
+
+    def load_state(self) -> dict:
+        items, schema, _ = self._read(self.directory / self.STATE)
+        payload, failed = decode_state(items, schema)
+        if failed:
+            self._set_aside(self.directory / self.STATE,
+                            f"{failed} item(s) could not be decoded",
+                            len(items) - failed)
+        return payload
+
+    def save_state(self, payload: dict):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._write(self.directory / self.STATE, encode_state(payload))
+
+    def load_segment(self, shard: int) -> dict:
+        items, schema, damaged = self._read(self._segment_path(shard))
+        records = {}
+        failed = 0
+        for item in items:
+            try:
+                record = decode_record(item, schema)
+            except DECODE_ERRORS:
+                failed += 1
+                continue
+            records[record.name.value] = record
+        if failed:
+            # Skipped like the items of a damaged chunk
+            self._set_aside(self._segment_path(shard),
+                            f"{failed} item(s) could not be decoded",
+                            len(records))
+        # Items from older schemas are re-encoded on save, and a damaged
+        # segment must be rewritten, so only an intact current segment gets
+        # a digest to compare against
+        if (schema == SCHEMA_VERSION and not damaged and not failed
+                and self._segment_path(shard).exists()):
+            self._digests[shard] = self._digest(b"".join(items))
+        return records
+
+    def segment_names(self, shard: int):
+        # Contact names in a segment file, read without touching the
+        # store's state, so it is safe to call from another thread;
+        # damaged chunks are skipped rather than recovered
+        try:
+            with open(self._segment_path(shard), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        try:
+            items, _, schema = decode_frames(data)
+        except (ValueError, struct.error):
+            return []
+        names = []
+        for item in items:
+            try:
+                names.append(decode_record(item, schema).name.value)
+            except DECODE_ERRORS:
+                continue
+        return names
+
+    def _save_segment(self, shard: int, records: dict):
+        items = [encode_record(r) for r in records.values()]
+        digest = self._digest(b"".join(items))
+        # Segments whose records did not change are left untouched;
+        # damaged segments have no digest and are always rewritten
+        if self._digests.get(shard) == digest:
+            return
+        self._write(self._segment_path(shard), items)
+        self._digests[shard] = digest
+        self.stamps[shard] = time.time()
+
+    def changed_since(self, stamp: float):
+        # Shards whose segment may have changed after stamp; a segment
+        # without a recorded stamp counts as changed
+        return {shard for shard in range(self.shards)
+                if self.stamps.get(shard, stamp) >= stamp}
+
+    def save_address_book(self, book):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        loaded = book.loaded_shards()
+        if self.rehash:
+            # Every record was loaded on attach; rewrite all segments
+            self.rehash = False
+            self._digests = {}
+        if len(loaded) == self.shards:
+            wanted = max(1, -(-len(book.data) // self.SHARD_SIZE))
+            if wanted > self.shards:
+                # Every record is in memory, so all segments get rewritten
+                # under the new shard count
+                self.shards = wanted
+                self._digests = {}
+                self.stamps = {}
+                loaded = set(range(wanted))
+
+        buckets = {shard: {} for shard in loaded}
+        for name, record in book.data.items():
+            buckets[self.shard_of(normalize_name(name))][name] = record
+        for shard, records in buckets.items():
+            self._save_segment(shard, records)
+        self._save_manifest()
@@ -0,0 +1,108 @@
+import json
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import quote
+
+from storage import write_atomic
+
+# Per-directory record of the last sync: the book it mirrors, when it ran,
+# the shard count at the time and the exported names grouped by shard
+SYNC_STATE = ".sync-state.json"
+
+
+def _escape(text: str) -> str:
+    return (text.replace("\\", "\\\\").replace(",", "\\,")
+            .replace(";", "\\;").replace("\n", "\\n"))
+
+
+def to_vcard(record) -> str:
+    name = _escape(record.name.value)
+    lines = ["BEGIN:VCARD", "VERSION:3.0", f"FN:{name}", f"N:{name};;;;"]
+    lines.extend(f"TEL;TYPE=VOICE:{p.value}" for p in record.phones)
+    if record.birthday is not None:
+        lines.append(f"BDAY:{record.birthday.value.isoformat()}")
+    if record.address is not None:
+        lines.append(f"ADR:;;{_escape(record.address.value)};;;;")
+    if record.modified:
+        stamp = datetime.fromtimestamp(record.modified, timezone.utc)
+        lines.append(f"REV:{stamp.strftime('%Y%m%dT%H%M%SZ')}")
+    lines.append("END:VCARD")
+    return "\r\n".join(lines) + "\r\n"
+
+
+def file_name(name: str) -> str:
+    return quote(name, safe=" ") + ".vcf"
+
+
+def _load_state(directory: Path):
+    try:
+        with open(directory / SYNC_STATE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def sync_vcards(book, book_name: str, directory: Path):
+    # Mirrors the book into directory, one .vcf file per contact. After the
+    # first run only shards that changed since the last sync are read, only
+    # records stamped after it are rewritten and files of contacts that
+    # disappeared are deleted. Returns (written, deleted, total).
+    directory.mkdir(parents=True, exist_ok=True)
+    state = _load_state(directory)
+    if state is not None and state["book"] != book_name:
+        raise ValueError(
+            f"{directory} is synced with book '{state['book']}'.")
+    started = time.time()
+
+    if state is None or state["shards"] != book.shard_count:
+        # First sync, or the book was resharded: compare against every
+        # exported name
+        book.load_all()
+        checked = set(range(book.shard_count))
+        previous = {}
+        if state is not None:
+            for names in state["names"].values():
+                for name in names:
+                    previous.setdefault(book.shard_of(name), set()).add(name)
+        since = None
+    else:
+        checked = book.load_changed_since(state["stamp"])
+        previous = {shard: set(state["names"].get(str(shard), ()))
+                    for shard in checked}
+        since = state["stamp"]
+
+    exported = set().union(*previous.values())
+    names = {shard: set(previous.get(shard, ())) for shard in checked}
+
+    # Deleted first, so a rename that only changes case does not remove the
+    # new file on a case-insensitive file system
+    deleted = 0
+    for shard in checked:
+        for name in [n for n in names[shard] if n not in book.data]:
+            (directory / file_name(name)).unlink(missing_ok=True)
+            names[shard].discard(name)
+            deleted += 1
+
+    written = 0
+    for name, record in book.data.items():
+        # Records in memory all belong to checked shards
+        if since is not None and name in exported and record.modified < since:
+            continue
+        with open(directory / file_name(name), "w", encoding="utf-8",
+                  newline="") as f:
+            f.write(to_vcard(record))
+        written += 1
+        if name not in exported:
+            names[book.shard_of(name)].add(name)
+
+    if since is not None:
+        kept = {int(s): v for s, v in state["names"].items()}
+        kept.update(names)
+        names = kept
+    new_state = {"book": book_name, "stamp": started,
+                 "shards": book.shard_count,
+                 "names": {str(s): sorted(v) for s, v in names.items() if v}}
+    write_atomic(directory / SYNC_STATE,
+                 [json.dumps(new_state, ensure_ascii=False).encode("utf-8")])
+    return written, deleted, sum(len(v) for v in names.values())
@@ -0,0 +1,303 @@
+import hashlib
+import json
+import re
+import struct
+from datetime import date
+
+import calendars
+from fields import Phone, normalize_name
+from serialization import SCHEMA_VERSION, migrate
+from storage import decode_frames, write_atomic
+
+# Per-book record of the files that passed the last check: their digests,
+# and the version of the rules they were checked against
+VERIFIED = "verified.json"
+# Bump when a rule is added or changed, so every file is checked again
+RULES_VERSION = 1
+
+# Whole-column checks: all values of one field joined by newlines are
+# matched at once, and only a column that fails is checked value by value
+_PHONES = re.compile(r"(?:[0-9]{10}\n)*")
+_DATES = re.compile(r"(?:[0-9]{4}-[0-9]{2}-[0-9]{2}\n)*")
+# A tag line that is empty or starts or ends with whitespace
+_BAD_TAG = re.compile(r"^$|^[^\S\n]|[^\S\n]$", re.MULTILINE)
+
+
+class Report:
+    def __init__(self):
+        self.files = 0
+        self.unchanged = 0
+        self.records = 0
+        self.notes = 0
+        # "<file>: <entry>: <what is wrong>"
+        self.problems = []
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _load_stamps(store) -> dict:
+    try:
+        with open(store.directory / VERIFIED, "r", encoding="utf-8") as f:
+            stamps = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if stamps.get("rules") != RULES_VERSION:
+        return {}
+    return stamps.get("files", {})
+
+
+def _save_stamps(store, files: dict):
+    stamps = {"rules": RULES_VERSION, "files": files}
+    write_atomic(store.directory / VERIFIED,
+                 [json.dumps(stamps).encode("utf-8")])
+
+
+def _read_items(data: bytes, problem):
+    # Decoded JSON objects of a framed file and their schema version
+    try:
+        items, damaged, schema = decode_frames(data)
+    except (ValueError, struct.error) as e:
+        problem("file", f"unreadable ({e or 'truncated header'})")
+        return [], SCHEMA_VERSION
+    if damaged:
+        problem("file", f"{damaged} damaged chunk(s)")
+    objects = []
+    for i, item in enumerate(items, 1):
+        try:
+            data = json.loads(item.decode("utf-8"))
+            if not isinstance(data, dict):
+                raise ValueError("not an object")
+        except ValueError as e:
+            problem(f"item {i}", f"not a JSON object ({e})")
+            continue
+        objects.append(data)
+    return objects, schema
+
+
+def _bad_phones(phones):
+    # Phones the Phone field rejects; the regex only clears the common
+    # case of ASCII digits, anything else is re-checked by the field
+    if _PHONES.fullmatch("".join(p + "\n" for p in phones)):
+        return []
+    bad = []
+    for phone in phones:
+        try:
+            Phone(phone)
+        except ValueError as e:
+            bad.append((phone, str(e)))
+    return bad
+
+
+def _bad_dates(values):
+    # ISO dates that are malformed or impossible; each distinct value is
+    # parsed once
+    bad = {}
+    shaped = _DATES.fullmatch("".join(v + "\n" for v in values))
+    for value in set(values):
+        if not shaped and not _DATES.fullmatch(value + "\n"):
+            bad[value] = "not a YYYY-MM-DD date"
+            continue
+        try:
+            date.fromisoformat(value)
+        except ValueError:
+            bad[value] = "not a valid date"
+    return bad
+
+
+def _is_text(value) -> bool:
+    return isinstance(value, str) and bool(value.strip())
+
+
+def check_records(objects, schema: int, problem, placed=None):
+    # Contact items of one segment; returns the contact names. placed(key)
+    # tells whether a normalised name belongs in this segment, None skips
+    # the placement check
+    records = []
+    for data in objects:
+        data = migrate("record", data, schema)
+        name = data.get("name")
+        if not _is_text(name):
+            problem(repr(name), "name is missing or empty")
+            continue
+        phones = data.get("phones")
+        if not isinstance(phones, list) or not all(
+                isinstance(p, str) for p in phones):
+            problem(name, "phones are not a list of strings")
+            phones = []
+        if not isinstance(data.get("modified"), (int, float)):
+            problem(name, "modification stamp is not a number")
+        if "address" in data and not _is_text(data["address"]):
+            problem(name, "address is empty or not text")
+        region = data.get("region")
+        if region is not None and region not in calendars.CALENDARS:
+            problem(name, f"unknown region {region!r}")
+        birthday = data.get("birthday")
+        if "birthday" in data and not isinstance(birthday, str):
+            problem(name, "birthday is not text")
+            birthday = None
+        records.append((name, phones, birthday))
+
+    phones = [p for _, numbers, _ in records for p in numbers]
+    bad_phones = dict(_bad_phones(phones))
+    births = [b for _, _, b in records if b is not None]
+    bad_dates = _bad_dates(births)
+    keys = {}
+    for name, numbers, birthday in records:
+        for phone in numbers:
+            if phone in bad_phones:
+                problem(name, f"phone {phone!r}: {bad_phones[phone]}")
+        if len(set(numbers)) != len(numbers):
+            problem(name, "the same phone is listed twice")
+        if birthday in bad_dates:
+            problem(name, f"birthday {birthday}: {bad_dates[birthday]}")
+        key = normalize_name(name)
+        if key in keys:
+            problem(name, f"duplicate of contact {keys[key]!r}")
+        keys[key] = name
+        if placed is not None and not placed(key):
+            problem(name, "stored in the wrong segment")
+    return [name for name, _, _ in records]
+
+
+def check_state(objects, schema: int, problem):
+    # Book settings and notes; returns (number of notes, linked names)
+    notes = []
+    header = {}
+    for data in objects:
+        if "id" in data:
+            notes.append(migrate("note", data, schema))
+        else:
+            header = migrate("state", data, schema)
+
+    days = header.get("birthdays_days", 1)
+    if not isinstance(days, int) or days < 1:
+        problem("settings", f"birthdays days {days!r} is not positive")
+    region = header.get("region")
+    if region is not None and region not in calendars.CALENDARS:
+        problem("settings", f"unknown region {region!r}")
+    if header.get("timezone") is not None:
+        try:
+            calendars.check_timezone(header["timezone"])
+        except ValueError as e:
+            problem("settings", str(e))
+
+    ids = set()
+    tags = []
+    linked = {}
+    for data in notes:
+        note_id = data.get("id")
+        label = f"note {note_id}"
+        if not isinstance(note_id, int) or note_id < 1:
+            problem(label, "id is not a positive integer")
+        elif note_id in ids:
+            problem(label, "duplicate id")
+        else:
+            ids.add(note_id)
+        if not _is_text(data.get("text")):
+            problem(label, "text is empty or not text")
+        note_tags = data.get("tags")
+        if not isinstance(note_tags, list) or not all(
+                isinstance(t, str) for t in note_tags):
+            problem(label, "tags are not a list of strings")
+        else:
+            if len(set(note_tags)) != len(note_tags):
+                problem(label, "the same tag is listed twice")
+            tags.extend((label, t) for t in note_tags)
+        contacts = data.get("contacts")
+        if not isinstance(contacts, list) or not all(
+                _is_text(c) for c in contacts):
+            problem(label, "contacts are not a list of names")
+        else:
+            for name in contacts:
+                linked.setdefault(name, []).append(label)
+        origin = data.get("origin")
+        if origin is not None and (not isinstance(origin, str)
+                                   or ":" not in origin):
+            problem(label, f"origin {origin!r} is not a global note id")
+
+    # Tags are stored stripped and in lower case
+    joined = "\n".join(t for _, t in tags)
+    if tags and (joined != joined.lower() or _BAD_TAG.search(joined)):
+        for label, tag in tags:
+            if not tag.strip() or tag != tag.strip().lower():
+                problem(label, f"tag {tag!r} is not normalised")
+
+    next_id = header.get("next_note_id", 1)
+    if not isinstance(next_id, int) or next_id <= max(ids, default=0):
+        problem("settings", f"next note id {next_id!r} is already used")
+    return len(notes), linked
+
+
+def verify_book(store, full: bool = False) -> Report:
+    # Checks the saved files of a book without loading them into a book.
+    # Files whose digest matches the last clean check are skipped unless
+    # full is set; stamps are only kept for files without problems.
+    report = Report()
+    stamps = {} if full else _load_stamps(store)
+    clean = {}
+    linked = None
+    # Shard -> contact names, for the note link check
+    names = {}
+
+    for path, shard in store.files():
+        if not path.is_file():
+            continue
+        report.files += 1
+        data = path.read_bytes()
+        digest = _digest(data)
+        if stamps.get(path.name) == digest:
+            report.unchanged += 1
+            clean[path.name] = digest
+            continue
+
+        found = []
+
+        def problem(entry, what, name=path.name):
+            found.append(f"{name}: {entry}: {what}")
+
+        objects, schema = _read_items(data, problem)
+        if shard is None:
+            count, linked = check_state(objects, schema, problem)
+            report.notes += count
+        else:
+            placed = None
+            if not store.rehash:
+                def placed(key, shard=shard):
+                    return store.shard_of(key) == shard
+            names[shard] = set(check_records(objects, schema, problem,
+                                             placed))
+            report.records += len(names[shard])
+        if found:
+            report.problems.extend(found)
+        else:
+            clean[path.name] = digest
+
+    if report.files > report.unchanged:
+        if linked is None:
+            # The notes were unchanged, but contacts may not be
+            state = store.directory / store.STATE
+            if state.is_file():
+                objects, schema = _read_items(state.read_bytes(),
+                                              lambda *_: None)
+                _, linked = check_state(objects, schema, lambda *_: None)
+        linked = linked or {}
+        # Names of unchanged segments are only read where links point
+        if store.rehash:
+            wanted = set(range(store.shards))
+        else:
+            wanted = {store.shard_of(normalize_name(n)) for n in linked}
+        for shard in wanted - names.keys():
+            names[shard] = set(store.segment_names(shard))
+        existing = set().union(*names.values())
+        for name, labels in sorted(linked.items()):
+            if name not in existing:
+                for label in labels:
+                    report.problems.append(
+                        f"{store.STATE}: {label}: linked to missing "
+                        f"contact {name!r}")
+                clean.pop(store.STATE, None)
+
+    _save_stamps(store, clean)
+    return report